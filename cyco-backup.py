@@ -8,17 +8,348 @@ import time
 import configparser
 import glob
 import threading
+import hashlib
+import json
+import zlib
+import gzip
+import contextlib
+import tarfile
+import io
+import queue
+import stat
+import collections
+import bisect
+import random
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 try:
-    from flask import send_file, render_template_string
+    from flask import send_file, render_template_string, Response
 except ImportError:
     logging.error("[cyco-backup] Failed to import Flask components")
     send_file = None
     render_template_string = None
+    Response = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MANIFEST_SUFFIX = '.manifest.json'
+INDEX_SUFFIX = '.idx.json'
+ARCHIVE_SUFFIXES = ('.tar.gz', '.tgz', '.tar.zst')
+HANDSHAKE_EXTENSIONS = ('.pcap', '.pcapng', '.22000', '.16800')
+LOG_EXTENSIONS = ('.log',)
+LOG_ANCHOR_BYTES = 64 * 1024
+
+
+class _ChunkReader(io.RawIOBase):
+    """Read-only file object that reassembles a file from its stored chunks"""
+
+    def __init__(self, chunk_paths):
+        self._chunk_paths = list(chunk_paths)
+        self._buffer = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer and self._chunk_paths:
+            chunk_path = self._chunk_paths.pop(0)
+            with open(chunk_path, 'rb') as f:
+                self._buffer = zlib.decompress(f.read())
+            if hashlib.sha256(self._buffer).hexdigest() != os.path.basename(chunk_path):
+                raise IOError("chunk " + os.path.basename(chunk_path) + " is corrupt")
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+
+class _JobCancelled(Exception):
+    pass
+
+
+class _BackupJob(object):
+    """Progress and cancellation state of one backup run"""
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.state = 'queued'
+        self.started = time.time()
+        self.finished = None
+        self.files_total = 0
+        self.files_done = 0
+        self.bytes_total = 0
+        self.bytes_done = 0
+        self.path = None
+        self.message = ''
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+        self.deduped_bytes = 0
+        self.log_reused_bytes = 0
+        self.checksum = None
+        self.paused = None
+        self.paused_seconds = 0
+        self.budget = None
+        self.cancel_event = threading.Event()
+
+    def check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise _JobCancelled()
+
+    def account(self, n):
+        """Count n bytes read from disk, waiting as long as the resource budget requires"""
+        self.bytes_done += n
+        if self.budget is not None:
+            self.budget.consume(n, self)
+
+    def sleep(self, seconds):
+        if self.cancel_event.wait(seconds):
+            raise _JobCancelled()
+
+    def percent(self):
+        if self.bytes_total <= 0:
+            return 0
+        return min(100, int(self.bytes_done * 100 / self.bytes_total))
+
+
+class _ProgressReader(object):
+    """Wraps a file so tarfile reads report progress and honour cancellation"""
+
+    def __init__(self, f, job):
+        self._f = f
+        self._job = job
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        self._job.check_cancelled()
+        data = self._f.read(size)
+        self.sha256.update(data)
+        self._job.account(len(data))
+        return data
+
+
+class _HashingWriter(object):
+    """Write-through file object that checksums everything written to it"""
+
+    def __init__(self, out):
+        self._out = out
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return self._out.write(data)
+
+
+class _QueueWriter(object):
+    """Write-only file object that hands data to a bounded queue read by a streaming response"""
+
+    def __init__(self, q, job):
+        self._queue = q
+        self._job = job
+
+    def write(self, data):
+        data = bytes(data)
+        while True:
+            self._job.check_cancelled()
+            try:
+                self._queue.put(data, timeout=0.5)
+                return len(data)
+            except queue.Full:
+                pass
+
+
+class _ResourceBudget(object):
+    """Caps the read rate of a job and pauses it while the system is overloaded"""
+
+    def __init__(self, bytes_per_second=0, max_load=0, min_mem_available_mb=0, max_memory_pressure=0):
+        self.bytes_per_second = bytes_per_second
+        self.max_load = max_load
+        self.min_mem_available_mb = min_mem_available_mb
+        self.max_memory_pressure = max_memory_pressure
+        self._next_read = 0
+        self._last_check = 0
+
+    def consume(self, n, job):
+        now = time.time()
+        if now - self._last_check >= 1:
+            self._last_check = now
+            self.wait_for_resources(job)
+            now = time.time()
+        if self.bytes_per_second > 0:
+            self._next_read = max(self._next_read, now) + float(n) / self.bytes_per_second
+            while self._next_read - time.time() > 0:
+                job.sleep(min(0.5, self._next_read - time.time()))
+
+    def wait_for_resources(self, job):
+        reason = self.overload_reason()
+        if reason is None:
+            return
+        logging.info("[cyco-backup] Pausing backup: " + reason)
+        paused_at = time.time()
+        while reason is not None:
+            job.paused = reason
+            job.sleep(2)
+            reason = self.overload_reason()
+        job.paused = None
+        job.paused_seconds += time.time() - paused_at
+        self._next_read = 0
+        logging.info("[cyco-backup] Resuming backup")
+
+    def overload_reason(self):
+        if self.max_load > 0:
+            load = os.getloadavg()[0]
+            if load > self.max_load:
+                return "load " + str(round(load, 2))
+        if self.min_mem_available_mb > 0:
+            available = _read_mem_available_mb()
+            if available is not None and available < self.min_mem_available_mb:
+                return "memory available " + str(available) + " MB"
+        if self.max_memory_pressure > 0:
+            pressure = _read_memory_pressure()
+            if pressure is not None and pressure > self.max_memory_pressure:
+                return "memory pressure " + str(pressure) + "%"
+        return None
+
+
+def _read_mem_available_mb():
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def _random_bytes(rng, n):
+    return rng.getrandbits(n * 8).to_bytes(n, 'little')
+
+
+def _read_rss_kb():
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def _read_memory_pressure():
+    """avg10 of the 'some' line in /proc/pressure/memory, None if PSI is not available"""
+    try:
+        with open('/proc/pressure/memory', 'r') as f:
+            for field in f.readline().split():
+                if field.startswith('avg10='):
+                    return float(field[6:])
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def _lower_thread_priority(nice, ionice_class):
+    """Lower the CPU and I/O priority of the calling thread only"""
+    tid = threading.get_native_id()
+    try:
+        if nice:
+            os.setpriority(os.PRIO_PROCESS, tid, int(nice))
+    except OSError as e:
+        logging.debug("[cyco-backup] Could not renice backup thread: " + str(e))
+    classes = {'idle': '3', 'best-effort': '2'}
+    if ionice_class in classes:
+        try:
+            subprocess.call(['ionice', '-c', classes[ionice_class], '-p', str(tid)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except OSError as e:
+            logging.debug("[cyco-backup] Could not ionice backup thread: " + str(e))
+
+
+def _gzip_block(block, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(block) + compressor.flush()
+
+
+def _zstd_block(block, level):
+    return zstandard.ZstdCompressor(level=level).compress(block)
+
+
+def _decompress_block(data, compression):
+    if compression == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data, 31)
+
+
+class _ParallelCompressor(object):
+    """Write-only file object that compresses fixed-size blocks on a thread pool.
+
+    Every block becomes an independent gzip member or zstd frame and blocks are written
+    in order, so the result is a standard multi-member .gz or .zst file. The position of
+    every block is kept in `blocks` as [raw_offset, raw_size, offset, size] so a single
+    block can later be decompressed on its own.
+    """
+
+    def __init__(self, out, compression='gzip', level=6, workers=1, block_size=1024 * 1024,
+                 initializer=None, initargs=()):
+        self._out = out
+        self._compress = _zstd_block if compression == 'zstd' else _gzip_block
+        self._level = level
+        self._workers = max(1, workers)
+        self._block_size = block_size
+        self._pool = ThreadPoolExecutor(max_workers=self._workers, initializer=initializer, initargs=initargs)
+        self._pending = collections.deque()
+        self._buffer = bytearray()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.blocks = []
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self._block_size:
+            self._submit(bytes(self._buffer[:self._block_size]))
+            del self._buffer[:self._block_size]
+        return len(data)
+
+    def _submit(self, block):
+        self._pending.append((self._pool.submit(self._compress, block, self._level), self.bytes_in, len(block)))
+        self.bytes_in += len(block)
+        while len(self._pending) > self._workers * 2:
+            self._write_next()
+
+    def _write_next(self):
+        future, raw_offset, raw_size = self._pending.popleft()
+        data = future.result()
+        self._out.write(data)
+        self.blocks.append([raw_offset, raw_size, self.bytes_out, len(data)])
+        self.bytes_out += len(data)
+
+    def close(self):
+        try:
+            if self._buffer:
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+            while self._pending:
+                self._write_next()
+        finally:
+            self._pool.shutdown(wait=True)
+
+    def abort(self):
+        for future, _, _ in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._pool.shutdown(wait=True)
+
 
 class CycoBackup(plugins.Plugin):
     __author__ = 'cycoslave'
-    __version__ = '1.1.1'
+    __version__ = '1.2.0'
     __license__ = 'GPL3'
     __description__ = 'Automatic backup plugin for Pwnagotchi configuration and data with configurable options'
 
@@ -27,16 +358,34 @@ class CycoBackup(plugins.Plugin):
         self.status = StatusFile('/root/.cyco-backup-status')
         self.last_backup_time = 0
         self.backup_interval = 3600
-        self.backup_in_progress = False
         self.upload_faces = []
         self.face_index = 0
-        self.agent = None
+        self.job = None
+        self.job_lock = threading.Lock()
+        self.job_queue = queue.Queue()
+        self.job_thread = None
+        self.announced_job = None
+        self.gc_pending = False
+        self.catalog = {}
+        self.catalog_lock = threading.Lock()
+        self.verify_cursor = None
+        self.verify_chunks = []
+        self.verify_chunks_pass = 0
+        self.verify_stop = threading.Event()
+        self.verify_thread = None
+        self.last_check_time = 0
+        self.last_check_result = None
+        self.last_mirror = None
 
     def on_loaded(self):
         try:
             self.options.setdefault('backup_path', '/root/backups/')
             self.options.setdefault('interval_hours', 1)
             self.options.setdefault('max_backups', 5)
+            self.options.setdefault('keep_hourly', 0)
+            self.options.setdefault('keep_daily', 0)
+            self.options.setdefault('keep_weekly', 0)
+            self.options.setdefault('max_total_mb', 0)
             self.options.setdefault('backup_config', True)
             self.options.setdefault('backup_system_files', True)
             self.options.setdefault('backup_custom_plugins', True)
@@ -44,10 +393,46 @@ class CycoBackup(plugins.Plugin):
             self.options.setdefault('backup_btsniffer_data', True)
             self.options.setdefault('backup_logs', True)
             self.options.setdefault('backup_last_session', False)
+            self.options.setdefault('backup_mode', 'archive')
+            self.options.setdefault('chunk_size_kb', 1024)
+            self.options.setdefault('skip_unchanged', True)
+            self.options.setdefault('skip_unchanged_ignore', ['/var/log/'])
+            self.options.setdefault('compression', 'gzip')
+            self.options.setdefault('compression_level', 6)
+            self.options.setdefault('compression_workers', 0)
+            self.options.setdefault('compression_block_kb', 1024)
+            self.options.setdefault('nice', 10)
+            self.options.setdefault('ionice', 'idle')
+            self.options.setdefault('read_limit_kbps', 0)
+            self.options.setdefault('max_load', 0)
+            self.options.setdefault('min_mem_available_mb', 0)
+            self.options.setdefault('max_memory_pressure', 0)
+            self.options.setdefault('restore_root', '/')
+            self.options.setdefault('dedup_handshakes', False)
+            self.options.setdefault('incremental_logs', False)
+            self.options.setdefault('verify_interval', 60)
+            self.options.setdefault('verify_budget_kb', 1024)
+            self.options.setdefault('verify_every_hours', 24)
+            self.options.setdefault('mirror_path', '')
+            self.options.setdefault('mirror_block_kb', 1024)
+            self.options.setdefault('benchmark_modes', ['archive', 'incremental'])
+            self.options.setdefault('benchmark_handshakes', 200)
+            self.options.setdefault('benchmark_log_mb', 10)
+            self.options.setdefault('benchmark_peers', 50)
+
+            if self.options['compression'] == 'zstd' and zstandard is None:
+                logging.warning("[cyco-backup] zstandard module not installed, falling back to gzip")
+                self.options['compression'] = 'gzip'
 
             self.backup_interval = int(self.options['interval_hours']) * 3600
             os.makedirs(self.options['backup_path'], exist_ok=True)
             self._load_upload_faces()
+            self._load_catalog()
+
+            if float(self.options['verify_interval']) > 0:
+                self.verify_thread = threading.Thread(target=self._verify_worker, name='cyco-backup-verify')
+                self.verify_thread.daemon = True
+                self.verify_thread.start()
 
             self.ready = True
             logging.info("[cyco-backup] Plugin loaded successfully")
@@ -88,14 +473,32 @@ class CycoBackup(plugins.Plugin):
         if not self.ready:
             return
         try:
-            self.agent = agent
             current_time = time.time()
             if (current_time - self.last_backup_time) >= self.backup_interval:
-                self._create_backup(agent)
-                self.last_backup_time = current_time
+                # Another job may be running, the scheduled backup is then tried again on the next tick
+                if self._start_job('scheduled') is not None:
+                    self.last_backup_time = current_time
         except Exception as e:
             logging.error("[cyco-backup] Error in on_tick: " + str(e))
 
+    def on_ui_update(self, ui):
+        job = self.job
+        if job is None:
+            return
+        if self._job_running():
+            if job.state == 'running':
+                if len(self.upload_faces) > 0:
+                    ui.set('face', self.upload_faces[self.face_index % len(self.upload_faces)])
+                    self.face_index += 1
+                if job.paused:
+                    ui.set('status', 'Backup paused (' + job.paused + ')')
+                else:
+                    ui.set('status', 'Backing up... ' + str(job.percent()) + '%')
+        elif self.announced_job is not job:
+            self.announced_job = job
+            if job.state != 'skipped':
+                ui.set('status', job.message)
+
     def on_webhook(self, path, request):
         try:
             if not self.ready or render_template_string is None:
@@ -104,6 +507,32 @@ class CycoBackup(plugins.Plugin):
             if path is None:
                 path = ''
 
+            if 'cancel' in path:
+                if self._cancel_job():
+                    return self._render_backup_status("Cancelling backup...")
+                return self._render_backup_status("No backup in progress")
+
+            if path.startswith('restore/'):
+                return self._restore_backup(path[len('restore/'):], request)
+
+            if path.startswith('api/backups'):
+                return self._api_backups(request)
+
+            if path.startswith('mirror'):
+                if not self.options['mirror_path']:
+                    return self._render_backup_status("No mirror_path configured")
+                if self._start_job('mirror') is None:
+                    return self._render_backup_status("Backup already in progress...")
+                return self._render_backup_status("Mirror started")
+
+            if path.startswith('benchmark'):
+                if self._start_job('benchmark') is None:
+                    return self._render_backup_status("Backup already in progress...")
+                return self._render_backup_status("Benchmark started")
+
+            if 'stream' in path:
+                return self._stream_backup()
+
             if 'backup' in path and 'download' not in path and 'delete' not in path:
                 return self._trigger_manual_backup()
 
@@ -139,22 +568,26 @@ class CycoBackup(plugins.Plugin):
             last_backup_time = self._get_last_backup_time()
 
             if not os.path.exists(self.options['backup_path']):
-                error_row = "<tr><td colspan='5' style='text-align: center; padding: 20px; color: red;'>Backup directory not found</td></tr>"
+                error_row = "<tr><td colspan='8' style='text-align: center; padding: 20px; color: red;'>Backup directory not found</td></tr>"
                 return self._render_page(error_row, last_backup_time)
 
-            backup_files = glob.glob(os.path.join(self.options['backup_path'], '*.tar.gz'))
-            backup_files += glob.glob(os.path.join(self.options['backup_path'], '*.tgz'))
-            backup_files.sort(reverse=True)
-
             rows = ""
-            for backup_path in backup_files:
-                filename = os.path.basename(backup_path)
-                size_mb = os.path.getsize(backup_path) / (1024 * 1024)
-                timestamp = datetime.fromtimestamp(os.path.getmtime(backup_path)).strftime('%Y-%m-%d %H:%M:%S')
-                rows += "<tr><td>" + filename + "</td><td>" + str(round(size_mb, 2)) + " MB</td><td>" + timestamp + "</td><td><a href=\"/plugins/cyco-backup/download/" + filename + "\" style=\"padding: 5px 10px; background-color: #2196F3; color: white; text-decoration: none; border-radius: 3px; display: inline-block;\">Download</a></td><td><a href=\"/plugins/cyco-backup/delete/" + filename + "\" style=\"padding: 5px 10px; background-color: #F44336; color: white; text-decoration: none; border-radius: 3px; display: inline-block;\" onclick=\"return confirm('Delete this backup?');\">Delete</a></td></tr>"
+            for record in self._catalog_records():
+                filename = record['filename']
+                size_mb = record['size'] / (1024 * 1024)
+                timestamp = datetime.fromtimestamp(record['created']).strftime('%Y-%m-%d %H:%M:%S')
+                items = str(record['items']) if record.get('items') is not None else "-"
+                ratio = str(round(record['ratio'], 2)) + "x" if record.get('ratio') else "-"
+                if record.get('verify_state') == 'corrupt':
+                    verified = "<span style='color: #F44336; font-weight: bold;'>CORRUPT</span>"
+                elif record.get('verified'):
+                    verified = "OK " + datetime.fromtimestamp(record['verified']).strftime('%Y-%m-%d %H:%M')
+                else:
+                    verified = "-"
+                rows += "<tr><td>" + filename + "</td><td>" + str(round(size_mb, 2)) + " MB</td><td>" + timestamp + "</td><td>" + items + "</td><td>" + ratio + "</td><td>" + verified + "</td><td><a href=\"/plugins/cyco-backup/download/" + filename + "\" style=\"padding: 5px 10px; background-color: #2196F3; color: white; text-decoration: none; border-radius: 3px; display: inline-block;\">Download</a></td><td><a href=\"/plugins/cyco-backup/delete/" + filename + "\" style=\"padding: 5px 10px; background-color: #F44336; color: white; text-decoration: none; border-radius: 3px; display: inline-block;\" onclick=\"return confirm('Delete this backup?');\">Delete</a></td></tr>"
 
             if not rows:
-                rows = "<tr><td colspan='5' style='text-align: center; padding: 20px;'>No backups available</td></tr>"
+                rows = "<tr><td colspan='8' style='text-align: center; padding: 20px;'>No backups available</td></tr>"
 
             return self._render_page(rows, last_backup_time)
 
@@ -162,9 +595,75 @@ class CycoBackup(plugins.Plugin):
             logging.error("[cyco-backup] Error listing backups: " + str(e), exc_info=True)
             return "<html><body>Error: " + str(e) + "</body></html>"
 
+    def _json_response(self, body, status=200):
+        return Response(json.dumps(body), status=status, mimetype='application/json')
+
+    def _api_backups(self, request):
+        """Paginated backup catalog: /plugins/cyco-backup/api/backups?page=1&per_page=20"""
+        try:
+            page = max(1, int(request.args.get('page', 1)))
+            per_page = min(500, max(1, int(request.args.get('per_page', 20))))
+        except (TypeError, ValueError):
+            return self._json_response({'error': 'invalid page or per_page'}, status=400)
+
+        records = self._catalog_records()
+        start = (page - 1) * per_page
+        return self._json_response({
+            'page': page,
+            'per_page': per_page,
+            'total': len(records),
+            'pages': (len(records) + per_page - 1) // per_page,
+            'backups': records[start:start + per_page],
+        })
+
     def _render_page(self, rows, last_backup_time):
-        status_msg = '<div style="padding: 10px; background-color: #fff3cd; border: 1px solid #ffc107; border-radius: 3px; margin-bottom: 20px;">Backup in progress...</div>' if self.backup_in_progress else ""
+        status_msg = ""
+        job = self.job
+        if self._job_running():
+            status_msg = '<div style="padding: 10px; background-color: #fff3cd; border: 1px solid #ffc107; border-radius: 3px; margin-bottom: 20px;">' + \
+                         {'mirror': 'Mirror', 'benchmark': 'Benchmark'}.get(job.kind, 'Backup') + ' in progress: ' + str(job.files_done) + '/' + str(job.files_total) + ' files, ' + \
+                         str(round(job.bytes_done / (1024 * 1024), 1)) + '/' + str(round(job.bytes_total / (1024 * 1024), 1)) + ' MB (' + \
+                         str(job.percent()) + '%)' + (' paused, ' + job.paused if job.paused else '') + \
+                         ' <a href="/plugins/cyco-backup/cancel" style="margin-left: 10px; color: #F44336;">Cancel</a></div>'
+        elif job is not None and job.state in ('failed', 'cancelled'):
+            status_msg = '<div style="padding: 10px; background-color: #fdecea; border: 1px solid #F44336; border-radius: 3px; margin-bottom: 20px;">' + \
+                         job.message + '</div>'
+        corrupt = [r['filename'] for r in self._catalog_records() if r.get('verify_state') == 'corrupt']
+        if corrupt:
+            status_msg += '<div style="padding: 10px; background-color: #fdecea; border: 1px solid #F44336; border-radius: 3px; margin-bottom: 20px;">' + \
+                          'Integrity check failed for: ' + ', '.join(corrupt) + '</div>'
         interval = str(self.options['interval_hours'])
+        setting = self._compression_setting()
+        compression = setting
+        record = self._load_throughput().get(setting)
+        if record:
+            compression += " (avg " + str(round(record['avg_mbps'], 2)) + " MB/s over " + str(record['runs']) + " runs)"
+        mirror = ""
+        if self.options['mirror_path']:
+            mirror = "<p><strong>Mirror:</strong> " + self.options['mirror_path']
+            if self.last_mirror:
+                mirror += " (last sync " + datetime.fromtimestamp(self.last_mirror['finished']).strftime('%Y-%m-%d %H:%M:%S') + \
+                          ", " + str(round(self.last_mirror['bytes_written'] / (1024 * 1024), 2)) + " MB written, " + \
+                          str(round(self.last_mirror['bytes_saved'] / (1024 * 1024), 2)) + " MB saved)"
+            mirror += " <a href=\"/plugins/cyco-backup/mirror\">Sync now</a></p>"
+        retention = self._retention_summary()
+        benchmark = ""
+        benchmarks = self._load_benchmarks()
+        if benchmarks:
+            latest = benchmarks[-1]
+            benchmark = "<p><strong>Last Benchmark:</strong> " + datetime.fromtimestamp(latest['created']).strftime('%Y-%m-%d %H:%M:%S') + \
+                        " (" + latest['compression'] + ", v" + str(latest.get('version')) + \
+                        (" " + latest['code'] if latest.get('code') else "") + ")<br>"
+            for result in latest['results']:
+                benchmark += result['mode'] + "/" + result['run'] + ": " + str(result['wall_s']) + "s wall, " + \
+                             str(result['cpu_s']) + "s CPU, " + str(round(result['peak_rss_kb'] / 1024.0, 1)) + " MB peak RSS, " + \
+                             str(round(result['bytes_written'] / (1024 * 1024), 2)) + " MB written" + \
+                             (" (" + str(result['ratio']) + "x)" if result['ratio'] else "") + "<br>"
+            benchmark += "</p>"
+        last_check = ""
+        if self.last_check_result:
+            last_check = "<p><strong>Last Check:</strong> " + datetime.fromtimestamp(self.last_check_time).strftime('%Y-%m-%d %H:%M:%S') + \
+                         " (" + self.last_check_result + ")</p>"
 
         html = """{% extends "base.html" %}
 {% set active_page = "plugins" %}
@@ -176,15 +675,25 @@ class CycoBackup(plugins.Plugin):
 <div style="margin-bottom: 20px; padding: 15px; background-color: #f0f0f0; border-radius: 5px;">
 <p><strong>Last Backup:</strong> """ + last_backup_time + """</p>
 <p><strong>Backup Interval:</strong> Every """ + interval + """ hour(s)</p>
+""" + retention + """
+""" + last_check + """
+<p><strong>Compression:</strong> """ + compression + """</p>
+""" + mirror + """
+""" + benchmark + """
 </div>
 <div style="margin-bottom: 20px;">
 <button onclick="window.location.href='/plugins/cyco-backup/backup'" style="padding: 10px 20px; background-color: #4CAF50; color: white; border: none; border-radius: 3px; cursor: pointer;">Run Backup Now</button>
+<button onclick="window.location.href='/plugins/cyco-backup/stream'" style="padding: 10px 20px; background-color: #2196F3; color: white; border: none; border-radius: 3px; cursor: pointer;">Download Fresh Backup</button>
+<button onclick="window.location.href='/plugins/cyco-backup/benchmark'" style="padding: 10px 20px; background-color: #9E9E9E; color: white; border: none; border-radius: 3px; cursor: pointer;">Run Benchmark</button>
 </div>
 <table style="width: 100%; border-collapse: collapse; margin-top: 20px;">
 <thead><tr style="background-color: #f2f2f2;">
 <th style="padding: 12px; text-align: left; border-bottom: 1px solid #ddd;">Filename</th>
 <th style="padding: 12px; text-align: left; border-bottom: 1px solid #ddd;">Size</th>
 <th style="padding: 12px; text-align: left; border-bottom: 1px solid #ddd;">Created</th>
+<th style="padding: 12px; text-align: left; border-bottom: 1px solid #ddd;">Items</th>
+<th style="padding: 12px; text-align: left; border-bottom: 1px solid #ddd;">Ratio</th>
+<th style="padding: 12px; text-align: left; border-bottom: 1px solid #ddd;">Verified</th>
 <th style="padding: 12px; text-align: left; border-bottom: 1px solid #ddd;">Download</th>
 <th style="padding: 12px; text-align: left; border-bottom: 1px solid #ddd;">Delete</th>
 </tr></thead>
@@ -199,15 +708,9 @@ class CycoBackup(plugins.Plugin):
 
     def _trigger_manual_backup(self):
         try:
-            if self.backup_in_progress:
-                return self._render_backup_status("Backup already in progress...")
-
             logging.info("[cyco-backup] Manual backup triggered")
-            self.backup_in_progress = True
-
-            backup_thread = threading.Thread(target=self._create_backup_standalone)
-            backup_thread.daemon = True
-            backup_thread.start()
+            if self._start_job('manual') is None:
+                return self._render_backup_status("Backup already in progress...")
 
             html = """{% extends "base.html" %}
 {% set active_page = "plugins" %}
@@ -227,7 +730,6 @@ class CycoBackup(plugins.Plugin):
 
         except Exception as e:
             logging.error("[cyco-backup] Error triggering backup: " + str(e), exc_info=True)
-            self.backup_in_progress = False
             return "<html><body>Error: " + str(e) + "</body></html>"
 
     def _render_backup_status(self, message):
@@ -259,7 +761,18 @@ class CycoBackup(plugins.Plugin):
             if not os.path.abspath(backup_path).startswith(os.path.abspath(self.options['backup_path'])):
                 return "<html><body>Invalid path</body></html>"
 
-            return send_file(backup_path, as_attachment=True, download_name=filename, mimetype='application/gzip')
+            if filename.endswith(MANIFEST_SUFFIX):
+                download_name = filename[:-len(MANIFEST_SUFFIX)] + self._archive_suffix()
+                return self._stream_response(download_name,
+                                             lambda fileobj, job: self._write_manifest_tar(fileobj, backup_path, job))
+
+            index = self._load_index(backup_path)
+            if index is not None and any('chunks' in m for m in index['members'].values()):
+                return self._stream_response(filename,
+                                             lambda fileobj, job: self._write_rehydrated_tar(fileobj, backup_path, index, job))
+
+            mimetype = 'application/zstd' if filename.endswith('.zst') else 'application/gzip'
+            return send_file(backup_path, as_attachment=True, download_name=filename, mimetype=mimetype)
 
         except Exception as e:
             logging.error("[cyco-backup] Download failed: " + str(e))
@@ -278,7 +791,12 @@ class CycoBackup(plugins.Plugin):
             if not os.path.abspath(backup_path).startswith(os.path.abspath(self.options['backup_path'])):
                 return self._render_backup_status("Invalid path")
 
-            os.remove(backup_path)
+            self._remove_backup_files(backup_path)
+            if os.path.isdir(os.path.join(self.options['backup_path'], 'chunks')):
+                if self._job_running():
+                    self.gc_pending = True
+                else:
+                    self._gc_chunks()
 
             html = """{% extends "base.html" %}
 {% set active_page = "plugins" %}
@@ -349,90 +867,1379 @@ class CycoBackup(plugins.Plugin):
 
         return 'pwnagotchi'
 
-    def _create_backup_standalone(self):
+    def _start_job(self, kind):
+        """Queue a backup job unless one is already queued or running"""
+        with self.job_lock:
+            if self._job_running():
+                return None
+            job = _BackupJob(kind)
+            self.job = job
+            if self.job_thread is None or not self.job_thread.is_alive():
+                self.job_thread = threading.Thread(target=self._job_worker, name='cyco-backup-worker')
+                self.job_thread.daemon = True
+                self.job_thread.start()
+            self.job_queue.put(job)
+            return job
+
+    def _job_running(self):
+        return self.job is not None and self.job.state in ('queued', 'running')
+
+    def _cancel_job(self):
+        job = self.job
+        if job is None or not self._job_running():
+            return False
+        job.cancel_event.set()
+        logging.info("[cyco-backup] Cancelling " + job.kind + " backup")
+        return True
+
+    def _job_worker(self):
+        while True:
+            job = self.job_queue.get()
+            if job is None:
+                return
+            self._run_job(job)
+
+    def _resource_budget(self):
+        return _ResourceBudget(bytes_per_second=int(self.options['read_limit_kbps']) * 1024,
+                               max_load=float(self.options['max_load']),
+                               min_mem_available_mb=int(self.options['min_mem_available_mb']),
+                               max_memory_pressure=float(self.options['max_memory_pressure']))
+
+    def _run_job(self, job):
+        job.state = 'running'
+        job.started = time.time()
+        job.budget = self._resource_budget()
+        _lower_thread_priority(self.options['nice'], self.options['ionice'])
         try:
-            pwnagotchi_name = self._get_name()
-            timestamp = datetime.now().strftime('%Y%m%d-%H%M%S')
-            backup_filename = pwnagotchi_name + "-backup-" + timestamp + ".tar.gz"
-            backup_path = os.path.join(self.options['backup_path'], backup_filename)
-
-            logging.info("[cyco-backup] Creating backup: " + str(backup_path))
-
-            backup_items = self._build_backup_items()
-            existing_items = [item for item in backup_items if os.path.exists(item.rstrip('*'))]
-
-            tar_cmd = ['tar', '-czf', backup_path] + existing_items
-            process = subprocess.Popen(tar_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            stdout, stderr = process.communicate()
-
-            if process.returncode == 0:
-                logging.info("[cyco-backup] Backup created: " + str(backup_path))
-                self.status.update()
-                self._cleanup_old_backups(pwnagotchi_name)
+            if job.kind == 'mirror':
+                self._mirror_backups(job)
+                job.state = 'done'
+                job.message = 'Mirror complete!'
+            elif job.kind == 'benchmark':
+                self._run_benchmark(job)
+                job.state = 'done'
+                job.message = 'Benchmark complete!'
+            elif job.kind == 'scheduled' and self.options['skip_unchanged'] and not self._has_changes():
+                job.state = 'skipped'
+                job.message = 'No changes since last backup'
             else:
-                logging.error("[cyco-backup] Backup failed: " + stderr.decode())
-
+                self._create_backup(job)
+                message = 'Backup complete!'
+                # The job stays running through the mirror, so it can be cancelled and nothing collects
+                # chunks or verifies archives while they are being copied
+                if self.options['mirror_path']:
+                    try:
+                        self._mirror_backups(job)
+                    except _JobCancelled:
+                        raise
+                    except Exception as e:
+                        logging.error("[cyco-backup] Mirror failed: " + str(e), exc_info=True)
+                        message = 'Backup complete, mirror failed: ' + str(e)
+                job.state = 'done'
+                job.message = message
+        except _JobCancelled:
+            job.state = 'cancelled'
+            job.message = 'Backup cancelled'
+            logging.info("[cyco-backup] Backup cancelled")
+            if os.path.isdir(os.path.join(self.options['backup_path'], 'chunks')):
+                self._gc_chunks()
         except Exception as e:
-            logging.error("[cyco-backup] Standalone backup failed: " + str(e), exc_info=True)
+            job.state = 'failed'
+            job.message = 'Backup failed: ' + str(e)
+            logging.error("[cyco-backup] Backup failed: " + str(e), exc_info=True)
         finally:
-            self.backup_in_progress = False
-
-    def _create_backup(self, agent):
+            job.finished = time.time()
+
+    def _create_backup(self, job):
+        pwnagotchi_name = self._get_name()
+        timestamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+
+        entries = list(self._iter_backup_entries(self._build_backup_items()))
+        snapshot = {}
+        for path, st in entries:
+            snapshot[path] = [st.st_size, st.st_mtime_ns, st.st_ino]
+            if stat.S_ISREG(st.st_mode):
+                job.files_total += 1
+                job.bytes_total += st.st_size
+
+        if self.options.get('backup_mode') == 'incremental':
+            job.path = self._create_incremental_backup(pwnagotchi_name, timestamp, entries, job)
+        else:
+            job.path = self._create_archive_backup(pwnagotchi_name, timestamp, entries, job)
+
+        self._catalog_add({
+            'filename': os.path.basename(job.path),
+            'mode': self.options.get('backup_mode'),
+            'size': job.stored_bytes,
+            'created': job.started,
+            'duration': round(time.time() - job.started, 2),
+            'items': job.files_done,
+            'checksum': job.checksum,
+            'ratio': round(float(job.raw_bytes) / job.stored_bytes, 2) if job.stored_bytes else None,
+        })
+        self.status.update(json.dumps({'backup': os.path.basename(job.path), 'checksum': job.checksum,
+                                       'members': job.files_done}))
+        self._save_change_manifest(snapshot)
+        self._cleanup_old_backups(pwnagotchi_name)
+
+    def _code_id(self):
+        """Short hash of this plugin file, so benchmarks of local changes without a version bump stay apart"""
         try:
-            display = agent.view()
-            pwnagotchi_name = self._get_name()
-            timestamp = datetime.now().strftime('%Y%m%d-%H%M%S')
-            backup_filename = pwnagotchi_name + "-backup-" + timestamp + ".tar.gz"
-            backup_path = os.path.join(self.options['backup_path'], backup_filename)
+            with open(__file__, 'rb') as f:
+                return hashlib.sha256(f.read()).hexdigest()[:12]
+        except (IOError, OSError, NameError):
+            return None
 
-            logging.info("[cyco-backup] Creating backup: " + str(backup_path))
+    def _benchmark_path(self):
+        return os.path.join(self.options['backup_path'], '.benchmark.json')
 
-            backup_items = self._build_backup_items()
-            existing_items = [item for item in backup_items if os.path.exists(item.rstrip('*'))]
-
-            tar_cmd = ['tar', '-czf', backup_path] + existing_items
-            process = subprocess.Popen(tar_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    def _load_benchmarks(self):
+        try:
+            with open(self._benchmark_path(), 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return []
+
+    def _build_benchmark_tree(self, root, rng):
+        """Create a synthetic device below root, shaped like the paths of _build_backup_items"""
+        def write(path, data):
+            path = os.path.join(root, path.lstrip('/'))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+
+        write('/etc/pwnagotchi/config.toml', b''.join(b'main.plugins.plugin%d.enabled = true\n' % i for i in range(200)))
+        write('/etc/hostname', b'benchmark\n')
+        write('/etc/hosts', b'127.0.0.1 localhost\n127.0.1.1 benchmark\n')
+        write('/etc/network/interfaces', b'source-directory /etc/network/interfaces.d\n')
+        write('/etc/wpa_supplicant/wpa_supplicant.conf', b'ctrl_interface=DIR=/var/run/wpa_supplicant\n')
+        write('/etc/ssh/ssh_host_ed25519_key', _random_bytes(rng, 400))
+        write('/boot/firmware/config.txt', b'dtoverlay=dwc2\n' * 20)
+        for i in range(10):
+            write('/usr/local/share/pwnagotchi/custom-plugins/plugin%d.py' % i,
+                  b''.join(b'    logging.info("[plugin%d] line %d")\n' % (i, n) for n in range(500)))
+        self._add_benchmark_handshakes(root, rng, 0, int(self.options['benchmark_handshakes']))
+        write('/root/handshakes/bluetooth_devices.json', json.dumps(dict(
+            ('%012x' % rng.getrandbits(48), {'name': 'device', 'count': rng.randint(1, 50)}) for _ in range(300))).encode())
+        self._add_benchmark_log(root, rng, int(float(self.options['benchmark_log_mb']) * 1024 * 1024))
+        for i in range(int(self.options['benchmark_peers'])):
+            write('/root/peers/%040x.json' % rng.getrandbits(160),
+                  json.dumps({'name': 'peer%d' % i, 'pwnd_tot': rng.randint(0, 5000), 'uptime': rng.randint(0, 10 ** 6)}).encode())
+        write('/root/.bashrc', b'export PATH=$PATH:/usr/local/bin\n' * 10)
+
+    def _add_benchmark_handshakes(self, root, rng, first, count):
+        directory = os.path.join(root, 'root/handshakes')
+        os.makedirs(directory, exist_ok=True)
+        for i in range(first, first + count):
+            name = os.path.join(directory, 'network%d_%012x' % (i, rng.getrandbits(48)))
+            with open(name + '.pcap', 'wb') as f:
+                f.write(b'\xd4\xc3\xb2\xa1\x02\x00\x04\x00' + _random_bytes(rng, rng.randint(2000, 60000)))
+            with open(name + '.22000', 'w') as f:
+                f.write('WPA*02*%032x*%012x*%012x\n' % (rng.getrandbits(128), rng.getrandbits(48), rng.getrandbits(48)))
+
+    def _add_benchmark_log(self, root, rng, size):
+        path = os.path.join(root, 'var/log/pwnagotchi.log')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        written = 0
+        with open(path, 'a') as f:
+            while written < size:
+                line = '[2024-01-01 12:%02d:%02d,%03d] [INFO] [agent] deauthing %012x channel %d rssi -%d\n' % (
+                    rng.randint(0, 59), rng.randint(0, 59), rng.randint(0, 999), rng.getrandbits(48),
+                    rng.randint(1, 13), rng.randint(30, 90))
+                f.write(line)
+                written += len(line)
+
+    def _run_benchmark(self, job):
+        """Back up a synthetic device with every benchmark mode and append the results to .benchmark.json
+
+        Each mode does a full run and a follow-up run after some handshakes and log lines were
+        added. CPU time is the whole pwnagotchi process and peak RSS is sampled while the run goes.
+        """
+        work = tempfile.mkdtemp(prefix='.benchmark-', dir=self.options['backup_path'])
+        root = os.path.join(work, 'device')
+        items = [os.path.join(root, item.lstrip('/')) for item in self._build_backup_items()]
+        results = []
+        try:
+            for mode in self.options['benchmark_modes']:
+                shutil.rmtree(root, ignore_errors=True)
+                rng = random.Random(0)
+                self._build_benchmark_tree(root, rng)
+                bench = type(self)()
+                bench.options = dict(self.options, backup_mode=mode, backup_path=os.path.join(work, mode))
+                os.makedirs(bench.options['backup_path'])
+                for run in ('full', 'next'):
+                    if run == 'next':
+                        self._add_benchmark_handshakes(root, rng, int(self.options['benchmark_handshakes']), 5)
+                        self._add_benchmark_log(root, rng, 64 * 1024)
+                    results.append(self._benchmark_run(bench, mode, run, items, job))
+        finally:
+            shutil.rmtree(work, ignore_errors=True)
+
+        history = self._load_benchmarks()
+        history.append({'version': self.__version__, 'code': self._code_id(), 'created': job.started, 'compression': self._compression_setting(),
+                        'handshakes': int(self.options['benchmark_handshakes']),
+                        'log_mb': float(self.options['benchmark_log_mb']),
+                        'peers': int(self.options['benchmark_peers']), 'results': results})
+        with open(self._benchmark_path() + '.tmp', 'w') as f:
+            json.dump(history[-20:], f, indent=2)
+        os.replace(self._benchmark_path() + '.tmp', self._benchmark_path())
+
+    def _benchmark_run(self, bench, mode, run, items, job):
+        entries = list(self._iter_backup_entries(items))
+        job.files_done = job.bytes_done = job.stored_bytes = job.raw_bytes = job.deduped_bytes = job.log_reused_bytes = 0
+        job.files_total = sum(1 for _, st in entries if stat.S_ISREG(st.st_mode))
+        job.bytes_total = sum(st.st_size for _, st in entries if stat.S_ISREG(st.st_mode))
+
+        def disk_usage():
+            return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(bench.options['backup_path'])
+                       for f in files if not f.startswith('.'))
+
+        peak = [_read_rss_kb() or 0]
+        done = threading.Event()
+
+        def sample():
+            while not done.wait(0.05):
+                peak[0] = max(peak[0], _read_rss_kb() or 0)
+
+        sampler = threading.Thread(target=sample, name='cyco-backup-rss')
+        sampler.daemon = True
+        sampler.start()
+        before = disk_usage()
+        cpu = os.times()
+        started = time.time()
+        try:
+            if mode == 'incremental':
+                bench._create_incremental_backup('benchmark', run, entries, job)
+            else:
+                bench._create_archive_backup('benchmark', run, entries, job)
+        finally:
+            wall = time.time() - started
+            cpu_end = os.times()
+            done.set()
+            sampler.join()
+        written = disk_usage() - before
+        result = {'mode': mode, 'run': run, 'files': job.files_total, 'source_bytes': job.bytes_total,
+                  'wall_s': round(wall, 3), 'cpu_s': round(cpu_end.user + cpu_end.system - cpu.user - cpu.system, 3),
+                  'peak_rss_kb': peak[0], 'bytes_written': written,
+                  'ratio': round(float(job.bytes_total) / written, 2) if written > 0 else None}
+        logging.info("[cyco-backup] Benchmark " + mode + "/" + run + ": " + str(result['wall_s']) + "s wall, " +
+                     str(result['cpu_s']) + "s cpu, " + str(round(written / (1024 * 1024), 2)) + " MB written")
+        return result
+
+    def _open_compressor(self, out):
+        return _ParallelCompressor(out, compression=self.options['compression'],
+                                   level=int(self.options['compression_level']), workers=self._compression_workers(),
+                                   block_size=int(self.options['compression_block_kb']) * 1024,
+                                   initializer=_lower_thread_priority,
+                                   initargs=(self.options['nice'], self.options['ionice']))
+
+    def _compression_workers(self):
+        return int(self.options['compression_workers']) or os.cpu_count() or 1
+
+    def _compression_setting(self):
+        return self.options['compression'] + ', level ' + str(self.options['compression_level']) + \
+            ', ' + str(self._compression_workers()) + ' workers'
+
+    def _throughput_path(self):
+        return os.path.join(self.options['backup_path'], '.throughput.json')
+
+    def _load_throughput(self):
+        try:
+            with open(self._throughput_path(), 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _record_throughput(self, bytes_in, bytes_out, seconds):
+        """Keep a running average of the archive throughput per compression setting"""
+        mbps = bytes_in / (1024 * 1024) / max(seconds, 0.001)
+        setting = self._compression_setting()
+        logging.info("[cyco-backup] Compressed " + str(round(bytes_in / (1024 * 1024), 2)) + " MB to " +
+                     str(round(bytes_out / (1024 * 1024), 2)) + " MB at " + str(round(mbps, 2)) + " MB/s (" + setting + ")")
+        try:
+            throughput = self._load_throughput()
+            record = throughput.get(setting, {'runs': 0, 'avg_mbps': 0.0})
+            record['avg_mbps'] = (record['avg_mbps'] * record['runs'] + mbps) / (record['runs'] + 1)
+            record['runs'] += 1
+            record['last_mbps'] = mbps
+            record['updated'] = time.time()
+            throughput[setting] = record
+            with open(self._throughput_path() + '.tmp', 'w') as f:
+                json.dump(throughput, f)
+            os.replace(self._throughput_path() + '.tmp', self._throughput_path())
+        except Exception as e:
+            logging.error("[cyco-backup] Could not save throughput: " + str(e))
+
+    def _write_tar(self, fileobj, entries, job, references=None):
+        """Write entries as a tar stream and return the member index: path -> position in the tar
+
+        With references (path -> member of the previous index) handshake captures and log files are
+        not put in the tar but kept in the chunk store, and the member records their chunks.
+        """
+        members = {}
+        with tarfile.open(fileobj=fileobj, mode='w|') as tar:
+            for path, st in entries:
+                job.check_cancelled()
+                member = False
+                if references is not None and stat.S_ISREG(st.st_mode):
+                    if self.options['dedup_handshakes'] and path.endswith(HANDSHAKE_EXTENSIONS):
+                        member = self._store_handshake(path, st, references.get(path), job)
+                    elif self.options['incremental_logs'] and path.endswith(LOG_EXTENSIONS):
+                        member = self._store_log_member(path, st, references.get(path), job)
+                if member is not False:
+                    if member is not None:
+                        members[path] = member
+                        job.files_done += 1
+                    continue
+                try:
+                    info = tar.gettarinfo(path, arcname=path.lstrip('/'))
+                except (IOError, OSError) as e:
+                    # Temporary files like bluetooth_devices.json.tmp can be gone since the tree was walked
+                    logging.warning("[cyco-backup] Skipping unreadable file " + path + ": " + str(e))
+                    continue
+                if info is None:
+                    continue
+                if not info.isreg():
+                    tar.addfile(info)
+                    if info.issym():
+                        members[path] = {'link': info.linkname, 'mode': info.mode, 'mtime': info.mtime}
+                    continue
+                try:
+                    f = open(path, 'rb')
+                except (IOError, OSError) as e:
+                    logging.warning("[cyco-backup] Skipping unreadable file " + path + ": " + str(e))
+                    continue
+                with f:
+                    reader = _ProgressReader(f, job)
+                    tar.addfile(info, reader)
+                padded_size = (info.size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+                members[path] = {'offset': tar.offset - padded_size, 'size': info.size,
+                                 'sha256': reader.sha256.hexdigest(), 'mode': info.mode, 'mtime': info.mtime}
+                job.files_done += 1
+        return members
+
+    def _store_handshake(self, path, st, previous, job):
+        """Put a capture in the chunk store, unless the previous backup already references it unchanged"""
+        if previous is not None and 'chunks' in previous and previous['size'] == st.st_size and \
+                previous['mtime_ns'] == st.st_mtime_ns and previous['inode'] == st.st_ino and \
+                all(os.path.exists(self._chunk_path(c)) for c in previous['chunks']):
+            job.bytes_done += st.st_size
+            job.deduped_bytes += st.st_size
+            job.raw_bytes += st.st_size
+            return previous
+        stats = {'new_chunks': 0, 'new_bytes': 0}
+        sha256 = hashlib.sha256()
+        try:
+            chunks = self._store_chunks(path, stats, job, sha256)
+        except (IOError, OSError) as e:
+            logging.warning("[cyco-backup] Skipping unreadable file " + path + ": " + str(e))
+            return None
+        job.stored_bytes += stats['new_bytes']
+        job.raw_bytes += st.st_size
+        if not stats['new_chunks']:
+            job.deduped_bytes += st.st_size
+        return {'chunks': chunks, 'size': st.st_size, 'sha256': sha256.hexdigest(), 'mode': st.st_mode & 0o7777,
+                'mtime': int(st.st_mtime), 'mtime_ns': st.st_mtime_ns, 'inode': st.st_ino}
+
+    def _store_log_member(self, path, st, previous, job):
+        """Archive member for a log file whose content lives in the chunk store"""
+        stats = {'new_chunks': 0, 'new_bytes': 0}
+        try:
+            member = self._store_log(path, st, previous, job, stats)
+        except (IOError, OSError) as e:
+            logging.warning("[cyco-backup] Skipping unreadable file " + path + ": " + str(e))
+            return None
+        job.stored_bytes += stats['new_bytes']
+        job.log_reused_bytes += stats['reused_bytes']
+        job.raw_bytes += st.st_size
+        member.update({'mode': st.st_mode & 0o7777, 'mtime': int(st.st_mtime)})
+        return member
+
+    def _store_log(self, path, st, previous, job, stats):
+        """Store only what was appended to a log since the previous backup
+
+        The previous backup recorded the log size and a hash of the bytes in front of it. If the
+        file is still the same inode, did not shrink and those bytes are unchanged, its chunks are
+        kept and reading resumes at the last (partial) chunk. Otherwise the log was rotated or
+        truncated and it is stored in full.
+        """
+        size = st.st_size
+        start = 0
+        if previous is not None and 'log_anchor' in previous and previous['inode'] == st.st_ino and \
+                previous['size'] <= size and all(os.path.exists(self._chunk_path(c)) for c in previous['chunks']):
+            if previous['size'] == size and previous['mtime_ns'] == st.st_mtime_ns:
+                start = size
+            elif self._log_anchor(path, previous['size']) == previous['log_anchor']:
+                start = previous['tail_offset']
+            else:
+                logging.info("[cyco-backup] " + path + " was rewritten, storing it in full")
+        elif previous is not None and 'log_anchor' in previous:
+            logging.info("[cyco-backup] " + path + " was rotated or truncated, storing it in full")
+
+        job.bytes_done += start
+        stats['reused_bytes'] = start
+        if start > 0 and start == size:
+            chunks, tail_offset, anchor = previous['chunks'], previous['tail_offset'], previous['log_anchor']
+        else:
+            chunk_size = int(self.options['chunk_size_kb']) * 1024
+            tail = self._store_chunks(path, stats, job, start=start, end=size)
+            chunks = (previous['chunks'][:-1] if start > 0 else []) + tail
+            tail_offset = start + max(len(tail) - 1, 0) * chunk_size
+            anchor = self._log_anchor(path, size)
+        return {'chunks': chunks, 'size': size, 'mtime_ns': st.st_mtime_ns, 'inode': st.st_ino,
+                'tail_offset': tail_offset, 'log_anchor': anchor}
+
+    def _log_anchor(self, path, end):
+        """Hash of the bytes in front of an offset, used to tell an appended log from a rewritten one"""
+        start = max(end - LOG_ANCHOR_BYTES, 0)
+        with open(path, 'rb') as f:
+            f.seek(start)
+            data = f.read(end - start)
+        if len(data) != end - start:
+            return None
+        return hashlib.sha256(data).hexdigest()
+
+    def _previous_references(self, pwnagotchi_name):
+        """Members of the newest archive index, used to skip re-hashing unchanged captures and logs"""
+        indexes = glob.glob(os.path.join(self.options['backup_path'], pwnagotchi_name + '*' + INDEX_SUFFIX))
+        if not indexes:
+            return {}
+        newest = max(indexes, key=os.path.getmtime)
+        try:
+            with open(newest, 'r') as f:
+                return json.load(f)['members']
+        except (IOError, OSError, ValueError, KeyError):
+            return {}
+
+    def _archive_suffix(self):
+        return '.tar.zst' if self.options['compression'] == 'zstd' else '.tar.gz'
+
+    def _stream_backup(self):
+        """Stream a freshly generated archive straight into the response, nothing is written to disk"""
+        filename = self._get_name() + "-backup-" + datetime.now().strftime('%Y%m%d-%H%M%S') + self._archive_suffix()
+
+        def write(fileobj, job):
+            entries = list(self._iter_backup_entries(self._build_backup_items()))
+            self._write_tar(fileobj, entries, job)
+
+        return self._stream_response(filename, write)
+
+    def _stream_response(self, filename, write):
+        """Run write(fileobj, job) on a producer thread and stream the compressed output with bounded memory"""
+        if Response is None:
+            return "<html><body>Streaming not available</body></html>"
+
+        job = _BackupJob('stream')
+        job.budget = self._resource_budget()
+        chunks = queue.Queue(maxsize=4)
+
+        def produce():
+            _lower_thread_priority(self.options['nice'], self.options['ionice'])
+            compressor = None
+            try:
+                compressor = self._open_compressor(_QueueWriter(chunks, job))
+                write(compressor, job)
+                compressor.close()
+                logging.info("[cyco-backup] Streamed " + filename + " (" + str(job.files_done) + " files, " +
+                             str(round(compressor.bytes_out / (1024 * 1024), 2)) + " MB)")
+            except _JobCancelled:
+                if compressor is not None:
+                    compressor.abort()
+                logging.info("[cyco-backup] Streaming download aborted by client")
+            except Exception as e:
+                if compressor is not None:
+                    compressor.abort()
+                logging.error("[cyco-backup] Streaming backup failed: " + str(e), exc_info=True)
+            finally:
+                while not job.cancel_event.is_set():
+                    try:
+                        chunks.put(None, timeout=0.5)
+                        break
+                    except queue.Full:
+                        pass
+
+        def generate():
+            try:
+                while True:
+                    data = chunks.get()
+                    if data is None:
+                        return
+                    yield data
+            finally:
+                job.cancel_event.set()
+
+        producer = threading.Thread(target=produce, name='cyco-backup-stream')
+        producer.daemon = True
+        producer.start()
+
+        mimetype = 'application/zstd' if filename.endswith('.zst') else 'application/gzip'
+        return Response(generate(), mimetype=mimetype,
+                        headers={'Content-Disposition': 'attachment; filename=' + filename})
+
+    def _write_rehydrated_tar(self, fileobj, backup_path, index, job):
+        """Copy a deduplicated archive and put the handshakes from the chunk store back in"""
+        with tarfile.open(fileobj=fileobj, mode='w|') as out:
+            with self._open_archive_stream(backup_path) as tar:
+                for info in tar:
+                    job.check_cancelled()
+                    out.addfile(info, tar.extractfile(info) if info.isreg() else None)
+            for path, member in index['members'].items():
+                if 'chunks' not in member:
+                    continue
+                job.check_cancelled()
+                info = tarfile.TarInfo(path.lstrip('/'))
+                info.size = member['size']
+                info.mode = member['mode']
+                info.mtime = member['mtime']
+                out.addfile(info, self._open_chunks(member['chunks']))
+                job.files_done += 1
+
+    def _create_archive_backup(self, pwnagotchi_name, timestamp, entries, job):
+        backup_filename = pwnagotchi_name + "-backup-" + timestamp + self._archive_suffix()
+        backup_path = os.path.join(self.options['backup_path'], backup_filename)
+        logging.info("[cyco-backup] Creating backup: " + str(backup_path))
+
+        started = time.time()
+        compressor = None
+        try:
+            references = None
+            if self.options['dedup_handshakes'] or self.options['incremental_logs']:
+                references = self._previous_references(pwnagotchi_name)
+            with open(backup_path + '.tmp', 'wb') as out:
+                hashing = _HashingWriter(out)
+                compressor = self._open_compressor(hashing)
+                members = self._write_tar(compressor, entries, job, references)
+                compressor.close()
+            index = {'version': 1, 'compression': self.options['compression'],
+                     'blocks': compressor.blocks, 'members': members}
+            with open(backup_path + INDEX_SUFFIX, 'w') as f:
+                json.dump(index, f)
+            os.replace(backup_path + '.tmp', backup_path)
+            # Members in the chunk store were already added by _store_handshake/_store_log_member
+            job.raw_bytes += compressor.bytes_in
+            job.stored_bytes += hashing.size
+            job.checksum = 'sha256:' + hashing.sha256.hexdigest()
+        except BaseException:
+            if compressor is not None:
+                compressor.abort()
+            for leftover in (backup_path + '.tmp', backup_path + INDEX_SUFFIX):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+            raise
+
+        if not int(self.options['read_limit_kbps']):
+            self._record_throughput(compressor.bytes_in, compressor.bytes_out, time.time() - started - job.paused_seconds)
+        if job.deduped_bytes:
+            logging.info("[cyco-backup] " + str(round(job.deduped_bytes / (1024 * 1024), 2)) +
+                         " MB of handshakes already in the chunk store")
+        if job.log_reused_bytes:
+            logging.info("[cyco-backup] " + str(round(job.log_reused_bytes / (1024 * 1024), 2)) +
+                         " MB of logs reused from the previous backup")
+        logging.info("[cyco-backup] Backup created: " + str(backup_path))
+        return backup_path
+
+    def _catalog_path(self):
+        return os.path.join(self.options['backup_path'], '.catalog.json')
+
+    def _load_catalog(self):
+        """Load the catalog and reconcile it once with the files in backup_path"""
+        try:
+            with open(self._catalog_path(), 'r') as f:
+                catalog = json.load(f).get('backups', {})
+        except (IOError, OSError, ValueError):
+            catalog = {}
+
+        on_disk = set()
+        for filename in os.listdir(self.options['backup_path']):
+            if not filename.endswith(ARCHIVE_SUFFIXES + (MANIFEST_SUFFIX,)):
+                continue
+            on_disk.add(filename)
+            if filename not in catalog:
+                filepath = os.path.join(self.options['backup_path'], filename)
+                catalog[filename] = {
+                    'filename': filename,
+                    'mode': 'incremental' if filename.endswith(MANIFEST_SUFFIX) else 'archive',
+                    'size': os.path.getsize(filepath),
+                    'created': os.path.getmtime(filepath),
+                    'duration': None,
+                    'items': None,
+                    'checksum': None,
+                    'ratio': None,
+                }
+
+        changed = set(catalog) != on_disk or not os.path.exists(self._catalog_path())
+        with self.catalog_lock:
+            self.catalog = dict((k, v) for k, v in catalog.items() if k in on_disk)
+        if changed:
+            self._save_catalog()
+
+    def _save_catalog(self):
+        try:
+            with self.catalog_lock:
+                with open(self._catalog_path() + '.tmp', 'w') as f:
+                    json.dump({'version': 1, 'backups': self.catalog}, f)
+                os.replace(self._catalog_path() + '.tmp', self._catalog_path())
+        except Exception as e:
+            logging.error("[cyco-backup] Could not save catalog: " + str(e))
+
+    def _catalog_add(self, record):
+        with self.catalog_lock:
+            self.catalog[record['filename']] = record
+        self._save_catalog()
+
+    def _catalog_remove(self, filename):
+        with self.catalog_lock:
+            if self.catalog.pop(filename, None) is None:
+                return
+        self._save_catalog()
+
+    def _catalog_update(self, filename, **fields):
+        with self.catalog_lock:
+            record = self.catalog.get(filename)
+            if record is None:
+                return
+            record.update(fields)
+        self._save_catalog()
+
+    def _catalog_records(self):
+        """Catalog records, newest first"""
+        with self.catalog_lock:
+            records = list(self.catalog.values())
+        records.sort(key=lambda r: r['created'], reverse=True)
+        return records
+
+    def _verify_worker(self):
+        _lower_thread_priority(self.options['nice'], self.options['ionice'])
+        while not self.verify_stop.wait(float(self.options['verify_interval'])):
+            if self._job_running():
+                continue
+            try:
+                self._verify_step(int(self.options['verify_budget_kb']) * 1024)
+            except Exception as e:
+                logging.error("[cyco-backup] Verification failed: " + str(e), exc_info=True)
+
+    def _next_verify_target(self):
+        """Backups not verified within verify_every_hours first, then one pass over the chunk store"""
+        horizon = time.time() - float(self.options['verify_every_hours']) * 3600
+        candidates = [r for r in self._catalog_records()
+                      if r.get('checksum') and r.get('verify_state') != 'corrupt' and (r.get('verified') or 0) < horizon]
+        if candidates:
+            record = min(candidates, key=lambda r: r.get('verified') or 0)
+            return {'kind': 'backup', 'name': record['filename'], 'checksum': record['checksum'], 'offset': 0,
+                    'sha256': hashlib.sha256(),
+                    'path': os.path.join(self.options['backup_path'], record['filename'])}
+
+        if not self.verify_chunks and self.verify_chunks_pass < horizon:
+            self.verify_chunks_pass = time.time()
+            for root, dirs, files in os.walk(os.path.join(self.options['backup_path'], 'chunks')):
+                self.verify_chunks.extend(os.path.join(root, name) for name in files if len(name) == 64)
+        if self.verify_chunks:
+            path = self.verify_chunks.pop()
+            return {'kind': 'chunk', 'name': os.path.basename(path), 'path': path}
+        return None
+
+    def _verify_step(self, budget):
+        """Read at most budget bytes of stored backups, continuing where the last step stopped"""
+        while budget > 0:
+            if self.verify_cursor is None:
+                self.verify_cursor = self._next_verify_target()
+                if self.verify_cursor is None:
+                    return
+            cursor = self.verify_cursor
+            try:
+                if cursor['kind'] == 'chunk':
+                    with open(cursor['path'], 'rb') as f:
+                        data = f.read()
+                    budget -= len(data)
+                    try:
+                        ok = hashlib.sha256(zlib.decompress(data)).hexdigest() == cursor['name']
+                    except zlib.error:
+                        ok = False
+                    if not ok:
+                        self._flag_corrupt_chunk(cursor['path'])
+                    self.verify_cursor = None
+                    continue
+
+                with open(cursor['path'], 'rb') as f:
+                    f.seek(cursor['offset'])
+                    data = f.read(min(budget, 1024 * 1024))
+                budget -= len(data)
+                cursor['offset'] += len(data)
+                cursor['sha256'].update(data)
+                if data:
+                    continue
+            except (IOError, OSError):
+                # deleted while being verified
+                self.verify_cursor = None
+                continue
+
+            self.verify_cursor = None
+            if 'sha256:' + cursor['sha256'].hexdigest() == cursor['checksum']:
+                self._catalog_update(cursor['name'], verified=time.time(), verify_state='ok')
+                logging.debug("[cyco-backup] Verified " + cursor['name'])
+            else:
+                self._catalog_update(cursor['name'], verified=time.time(), verify_state='corrupt')
+                logging.error("[cyco-backup] Checksum mismatch, backup is corrupt: " + cursor['name'])
+
+    def _flag_corrupt_chunk(self, chunk_path):
+        """Move a bad chunk aside, so the next backup stores it again, and flag every backup using it"""
+        digest = os.path.basename(chunk_path)
+        logging.error("[cyco-backup] Corrupt chunk " + digest)
+        os.replace(chunk_path, chunk_path + '.corrupt')
+        for record in self._catalog_records():
+            backup_path = os.path.join(self.options['backup_path'], record['filename'])
+            try:
+                if record['filename'].endswith(MANIFEST_SUFFIX):
+                    members = self._load_manifest(backup_path)['entries']
+                else:
+                    members = (self._load_index(backup_path) or {'members': {}})['members'].values()
+            except (IOError, OSError, ValueError):
+                continue
+            if any(digest in member.get('chunks', []) for member in members):
+                self._catalog_update(record['filename'], verify_state='corrupt')
+                logging.error("[cyco-backup] Backup " + record['filename'] + " references corrupt chunk " + digest)
+
+    def _mirror_backups(self, job):
+        """Sync backup_path to mirror_path, writing only chunks and blocks the mirror does not have yet"""
+        mirror_path = self.options['mirror_path']
+        if not os.path.isdir(mirror_path):
+            logging.warning("[cyco-backup] Mirror target " + mirror_path + " is not mounted, skipping mirror")
+            return
+        backup_path = self.options['backup_path']
+        stats = {'files': 0, 'bytes_written': 0, 'bytes_saved': 0}
+
+        sources = {}
+        for name in os.listdir(backup_path):
+            if name.endswith(ARCHIVE_SUFFIXES + (MANIFEST_SUFFIX, INDEX_SUFFIX)) or name == '.catalog.json':
+                sources[name] = os.path.join(backup_path, name)
+        chunk_root = os.path.join(backup_path, 'chunks')
+        for root, dirs, files in os.walk(chunk_root):
+            for name in files:
+                if len(name) == 64:
+                    sources[os.path.join('chunks', name[:2], name)] = os.path.join(root, name)
+
+        job.files_total = len(sources)
+        job.bytes_total = sum(os.path.getsize(p) for p in sources.values())
+        logging.info("[cyco-backup] Mirroring " + str(len(sources)) + " files to " + mirror_path)
+
+        # chunks first, so a backup is only visible on the mirror once its data is there
+        for relative in sorted(sources, key=lambda r: not r.startswith('chunks')):
+            job.check_cancelled()
+            target = os.path.join(mirror_path, relative)
+            if relative.startswith('chunks'):
+                size = os.path.getsize(sources[relative])
+                if os.path.exists(target):
+                    stats['bytes_saved'] += size
+                    job.bytes_done += size
+                else:
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    self._mirror_file(sources[relative], target, job, stats)
+            else:
+                if not os.path.exists(target) and not os.path.exists(target + '.part'):
+                    basis = self._mirror_basis(mirror_path, relative, sources)
+                    if basis is not None:
+                        # Archives get a new name every run, the one retention just dropped is recycled in place
+                        logging.info("[cyco-backup] Mirroring " + relative + " over " + os.path.basename(basis))
+                        os.replace(basis, target + '.part')
+                self._mirror_file(sources[relative], target, job, stats)
+            job.files_done += 1
+
+        # Only files the mirror wrote itself are removed, mirror_path may be a stick with other data on it
+        candidates = os.listdir(mirror_path)
+        for root, dirs, files in os.walk(os.path.join(mirror_path, 'chunks')):
+            for name in files:
+                candidates.append(os.path.relpath(os.path.join(root, name), mirror_path))
+        for relative in candidates:
+            target = os.path.join(mirror_path, relative)
+            if not os.path.isfile(target) or not self._mirror_owned(relative):
+                continue
+            # A .part is kept for resuming, unless its source is gone
+            if (relative[:-len('.part')] if relative.endswith('.part') else relative) not in sources:
+                os.remove(target)
+
+        stats['finished'] = time.time()
+        self.last_mirror = stats
+        logging.info("[cyco-backup] Mirror complete: " + str(round(stats['bytes_written'] / (1024 * 1024), 2)) +
+                     " MB written, " + str(round(stats['bytes_saved'] / (1024 * 1024), 2)) + " MB saved")
+
+    def _mirror_basis(self, mirror_path, relative, sources):
+        """Newest archive of the same unit on the mirror that is no longer in backup_path, or None"""
+        suffix = [s for s in ARCHIVE_SUFFIXES if relative.endswith(s)]
+        if not suffix or '-backup-' not in relative:
+            return None
+        unit = relative.split('-backup-')[0] + '-backup-'
+        stale = [os.path.join(mirror_path, name) for name in os.listdir(mirror_path)
+                 if name.startswith(unit) and name.endswith(suffix[0]) and name not in sources and
+                 os.path.isfile(os.path.join(mirror_path, name))]
+        return max(stale, key=os.path.getmtime) if stale else None
+
+    def _mirror_owned(self, relative):
+        """True for mirror paths _mirror_backups writes: archives, indexes, manifests, the catalog and chunks"""
+        if relative.endswith('.part'):
+            relative = relative[:-len('.part')]
+        parts = relative.split(os.sep)
+        if len(parts) == 1:
+            return relative.endswith(ARCHIVE_SUFFIXES + (MANIFEST_SUFFIX, INDEX_SUFFIX)) or relative == '.catalog.json'
+        return len(parts) == 3 and parts[0] == 'chunks' and len(parts[2]) == 64 and parts[1] == parts[2][:2] and \
+            not parts[2].strip('0123456789abcdef')
+
+    def _mirror_file(self, source, target, job, stats):
+        """Copy source over target block by block, only writing blocks that differ.
+
+        The copy goes to target.part which survives an interruption, so the next run resumes
+        by comparing the blocks that were already written.
+        """
+        st = os.stat(source)
+        if os.path.exists(target):
+            tst = os.stat(target)
+            if tst.st_size == st.st_size and int(tst.st_mtime) == int(st.st_mtime):
+                stats['bytes_saved'] += st.st_size
+                job.bytes_done += st.st_size
+                return
+            if not os.path.exists(target + '.part'):
+                os.replace(target, target + '.part')
+
+        block_size = int(self.options['mirror_block_kb']) * 1024
+        mode = 'r+b' if os.path.exists(target + '.part') else 'w+b'
+        with open(source, 'rb') as src, open(target + '.part', mode) as dst:
+            offset = 0
+            while True:
+                job.check_cancelled()
+                data = src.read(block_size)
+                if not data:
+                    break
+                job.account(len(data))
+                dst.seek(offset)
+                if dst.read(len(data)) == data:
+                    stats['bytes_saved'] += len(data)
+                else:
+                    dst.seek(offset)
+                    dst.write(data)
+                    stats['bytes_written'] += len(data)
+                offset += len(data)
+            dst.truncate(offset)
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.utime(target + '.part', (st.st_atime, st.st_mtime))
+        os.replace(target + '.part', target)
+        stats['files'] += 1
+
+    def _change_manifest_path(self):
+        return os.path.join(self.options['backup_path'], '.change-manifest.json')
+
+    def _snapshot_backup_items(self):
+        """Stat-only view of everything the backup covers: path -> [size, mtime_ns, inode]"""
+        snapshot = {}
+        for path, st in self._iter_backup_entries(self._build_backup_items()):
+            snapshot[path] = [st.st_size, st.st_mtime_ns, st.st_ino]
+        return snapshot
+
+    def _load_change_manifest(self):
+        try:
+            with open(self._change_manifest_path(), 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
 
-            face_index = 0
-            while process.poll() is None:
-                if len(self.upload_faces) > 0:
-                    current_face = self.upload_faces[face_index % len(self.upload_faces)]
-                    display.set('face', current_face)
-                display.set('status', 'Backing up...')
-                display.update()
-                face_index += 1
-                time.sleep(0.5)
-
-            stdout, stderr = process.communicate()
-
-            if process.returncode == 0:
-                logging.info("[cyco-backup] Backup created: " + str(backup_path))
-                display.set('status', 'Backup complete!')
-                display.update()
-                self.status.update()
-                self._cleanup_old_backups(pwnagotchi_name)
+    def _save_change_manifest(self, snapshot):
+        try:
+            manifest = {'updated': time.time(), 'entries': snapshot}
+            with open(self._change_manifest_path() + '.tmp', 'w') as f:
+                json.dump(manifest, f)
+            os.replace(self._change_manifest_path() + '.tmp', self._change_manifest_path())
+        except Exception as e:
+            logging.error("[cyco-backup] Could not save change manifest: " + str(e))
+
+    def _has_changes(self):
+        """Compare the backup items against the manifest of the last successful backup"""
+        self.last_check_time = time.time()
+        previous = self._load_change_manifest().get('entries')
+        if previous is None:
+            self.last_check_result = 'changed'
+            return True
+        ignore = tuple(self.options['skip_unchanged_ignore'])
+        current = self._snapshot_backup_items()
+        if {k: v for k, v in current.items() if not k.startswith(ignore)} != \
+                {k: v for k, v in previous.items() if not k.startswith(ignore)}:
+            self.last_check_result = 'changed'
+            return True
+        self.last_check_result = 'no change'
+        logging.info("[cyco-backup] No changes since last backup, skipping")
+        return False
+
+    def _chunk_path(self, digest):
+        return os.path.join(self.options['backup_path'], 'chunks', digest[:2], digest)
+
+    def _iter_backup_entries(self, backup_items):
+        """Walk the backup items and yield (path, lstat) for every entry, without duplicates"""
+        seen = set()
+        for item in backup_items:
+            item = item.rstrip('*')
+            if not os.path.lexists(item):
+                continue
+            if os.path.isdir(item) and not os.path.islink(item):
+                for root, dirs, files in os.walk(item):
+                    dirs.sort()
+                    linked_dirs = [d for d in dirs if os.path.islink(os.path.join(root, d))]
+                    for name in [''] + sorted(files) + linked_dirs:
+                        path = os.path.normpath(os.path.join(root, name))
+                        if path not in seen:
+                            seen.add(path)
+                            st = self._lstat(path)
+                            if st is not None:
+                                yield path, st
+            else:
+                path = os.path.normpath(item)
+                if path not in seen:
+                    seen.add(path)
+                    st = self._lstat(path)
+                    if st is not None:
+                        yield path, st
+
+    def _lstat(self, path):
+        """lstat, or None for a file that was removed while the tree was walked"""
+        try:
+            return os.lstat(path)
+        except (IOError, OSError) as e:
+            logging.debug("[cyco-backup] Skipping vanished file " + path + ": " + str(e))
+            return None
+
+    def _list_manifests(self, pwnagotchi_name=None):
+        manifests = glob.glob(os.path.join(self.options['backup_path'], '*' + MANIFEST_SUFFIX))
+        if pwnagotchi_name:
+            manifests = [m for m in manifests if os.path.basename(m).startswith(pwnagotchi_name)]
+        manifests.sort(key=os.path.getmtime, reverse=True)
+        return manifests
+
+    def _load_manifest(self, manifest_path):
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+
+    def _store_chunks(self, path, stats, job, sha256=None, start=0, end=None):
+        """Split path (or the start..end range of it) into chunks, writing the ones not stored yet"""
+        chunk_size = int(self.options['chunk_size_kb']) * 1024
+        chunks = []
+        with open(path, 'rb') as f:
+            f.seek(start)
+            position = start
+            while True:
+                job.check_cancelled()
+                data = f.read(chunk_size if end is None else min(chunk_size, end - position))
+                if not data:
+                    break
+                position += len(data)
+                job.account(len(data))
+                if sha256 is not None:
+                    sha256.update(data)
+                digest = hashlib.sha256(data).hexdigest()
+                chunks.append(digest)
+                chunk_path = self._chunk_path(digest)
+                if os.path.exists(chunk_path):
+                    continue
+                os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
+                compressed = zlib.compress(data, 6)
+                with open(chunk_path + '.tmp', 'wb') as out:
+                    out.write(compressed)
+                os.replace(chunk_path + '.tmp', chunk_path)
+                stats['new_chunks'] += 1
+                stats['new_bytes'] += len(compressed)
+        return chunks
+
+    def _create_incremental_backup(self, pwnagotchi_name, timestamp, entries, job):
+        """Store new chunks in the chunk store and write a manifest referencing them"""
+        manifest_path = os.path.join(self.options['backup_path'],
+                                     pwnagotchi_name + "-backup-" + timestamp + MANIFEST_SUFFIX)
+        previous = {}
+        manifests = self._list_manifests(pwnagotchi_name)
+        if manifests:
+            try:
+                for entry in self._load_manifest(manifests[0])['entries']:
+                    previous[entry['path']] = entry
+            except Exception as e:
+                logging.warning("[cyco-backup] Could not read previous manifest: " + str(e))
+
+        stats = {'files': 0, 'reused': 0, 'appended': 0, 'new_chunks': 0, 'new_bytes': 0}
+        manifest_entries = []
+        for path, st in entries:
+            job.check_cancelled()
+            entry = {'path': path, 'mode': st.st_mode, 'mtime': st.st_mtime}
+            if os.path.islink(path):
+                entry['type'] = 'symlink'
+                entry['target'] = os.readlink(path)
+            elif os.path.isdir(path):
+                entry['type'] = 'dir'
+            elif os.path.isfile(path):
+                entry.update({'type': 'file', 'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'inode': st.st_ino})
+                old = previous.get(path)
+                if self.options['incremental_logs'] and path.endswith(LOG_EXTENSIONS):
+                    try:
+                        entry.update(self._store_log(path, st, old, job, stats))
+                    except (IOError, OSError) as e:
+                        logging.warning("[cyco-backup] Skipping unreadable file " + path + ": " + str(e))
+                        continue
+                    reused = stats.pop('reused_bytes')
+                    if reused == st.st_size:
+                        stats['reused'] += 1
+                    elif reused:
+                        stats['appended'] += 1
+                elif old and old.get('type') == 'file' and old['size'] == st.st_size and \
+                        old['mtime_ns'] == st.st_mtime_ns and old['inode'] == st.st_ino and \
+                        all(os.path.exists(self._chunk_path(c)) for c in old['chunks']):
+                    entry['chunks'] = old['chunks']
+                    job.bytes_done += st.st_size
+                    stats['reused'] += 1
+                else:
+                    try:
+                        entry['chunks'] = self._store_chunks(path, stats, job)
+                    except (IOError, OSError) as e:
+                        logging.warning("[cyco-backup] Skipping unreadable file " + path + ": " + str(e))
+                        continue
+                stats['files'] += 1
+                job.files_done += 1
             else:
-                logging.error("[cyco-backup] Backup failed: " + stderr.decode())
+                continue
+            manifest_entries.append(entry)
+
+        manifest = {'version': 1, 'name': pwnagotchi_name, 'created': time.time(),
+                    'chunk_size': int(self.options['chunk_size_kb']) * 1024, 'entries': manifest_entries}
+        data = json.dumps(manifest).encode()
+        with open(manifest_path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(manifest_path + '.tmp', manifest_path)
+        job.raw_bytes = sum(entry.get('size', 0) for entry in manifest_entries)
+        job.stored_bytes = len(data) + stats['new_bytes']
+        job.checksum = 'sha256:' + hashlib.sha256(data).hexdigest()
+
+        logging.info("[cyco-backup] Incremental backup created: " + manifest_path + " (" + str(stats['files']) +
+                     " files, " + str(stats['reused']) + " unchanged, " + str(stats['appended']) + " logs appended to, " + str(stats['new_chunks']) +
+                     " new chunks, " + str(round(stats['new_bytes'] / (1024 * 1024), 2)) + " MB written)")
+        return manifest_path
+
+    def _open_chunks(self, chunks):
+        return io.BufferedReader(_ChunkReader(self._chunk_path(c) for c in chunks))
+
+    def _write_manifest_tar(self, fileobj, manifest_path, job):
+        """Rebuild a regular tar stream from a manifest and its chunks"""
+        manifest = self._load_manifest(manifest_path)
+        with tarfile.open(fileobj=fileobj, mode='w|') as tar:
+            for entry in manifest['entries']:
+                job.check_cancelled()
+                info = tarfile.TarInfo(entry['path'].lstrip('/'))
+                info.mode = entry['mode'] & 0o7777
+                info.mtime = int(entry['mtime'])
+                if entry['type'] == 'dir':
+                    info.type = tarfile.DIRTYPE
+                    tar.addfile(info)
+                elif entry['type'] == 'symlink':
+                    info.type = tarfile.SYMTYPE
+                    info.linkname = entry['target']
+                    tar.addfile(info)
+                else:
+                    info.size = entry['size']
+                    tar.addfile(info, self._open_chunks(entry['chunks']))
+                    job.files_done += 1
+
+    def _gc_chunks(self):
+        """Delete chunks that are no longer referenced by any manifest or archive index"""
+        refcounts = {}
+        for manifest_path in self._list_manifests():
+            try:
+                for entry in self._load_manifest(manifest_path)['entries']:
+                    for digest in entry.get('chunks', []):
+                        refcounts[digest] = refcounts.get(digest, 0) + 1
+            except Exception as e:
+                logging.error("[cyco-backup] Could not read manifest " + manifest_path + ", skipping chunk cleanup: " + str(e))
+                return
+        for index_path in glob.glob(os.path.join(self.options['backup_path'], '*' + INDEX_SUFFIX)):
+            try:
+                with open(index_path, 'r') as f:
+                    members = json.load(f)['members']
+            except Exception as e:
+                logging.error("[cyco-backup] Could not read index " + index_path + ", skipping chunk cleanup: " + str(e))
+                return
+            for member in members.values():
+                for digest in member.get('chunks', []):
+                    refcounts[digest] = refcounts.get(digest, 0) + 1
+
+        removed = 0
+        chunk_root = os.path.join(self.options['backup_path'], 'chunks')
+        for root, dirs, files in os.walk(chunk_root):
+            for name in files:
+                if refcounts.get(name, 0) == 0:
+                    os.remove(os.path.join(root, name))
+                    removed += 1
+        if removed:
+            logging.info("[cyco-backup] Removed " + str(removed) + " unreferenced chunks")
+
+    def _remove_backup_files(self, backup_path):
+        os.remove(backup_path)
+        if os.path.exists(backup_path + INDEX_SUFFIX):
+            os.remove(backup_path + INDEX_SUFFIX)
+        self._catalog_remove(os.path.basename(backup_path))
+
+    def _load_index(self, backup_path):
+        try:
+            with open(backup_path + INDEX_SUFFIX, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _read_indexed_member(self, backup_path, index, member):
+        """Decompress only the blocks that hold one member of an indexed archive"""
+        blocks = index['blocks']
+        start = member['offset']
+        end = start + member['size']
+        first = max(0, bisect.bisect_right([b[0] for b in blocks], start) - 1)
+        data = bytearray()
+        with open(backup_path, 'rb') as f:
+            for raw_offset, raw_size, offset, size in blocks[first:]:
+                if raw_offset >= end:
+                    break
+                f.seek(offset)
+                data += _decompress_block(f.read(size), index['compression'])
+        skip = start - blocks[first][0] if blocks else 0
+        return bytes(data[skip:skip + member['size']])
+
+    @contextlib.contextmanager
+    def _open_archive_stream(self, backup_path):
+        """Tar stream over the whole archive, archives are written as many gzip members or zstd frames"""
+        if backup_path.endswith('.zst'):
+            if zstandard is None:
+                raise IOError("zstandard module not installed")
+            # Every block is its own frame, without read_across_frames the reader stops after the first one
+            raw = zstandard.ZstdDecompressor().stream_reader(open(backup_path, 'rb'), closefd=True,
+                                                              read_across_frames=True)
+        else:
+            # tarfile's own gzip stream stops after the first member, gzip reads across all of them
+            raw = gzip.open(backup_path, 'rb')
+        try:
+            with tarfile.open(fileobj=raw, mode='r|') as tar:
+                yield tar
+        finally:
+            raw.close()
+
+    def _iter_archive_members(self, backup_path, wanted):
+        """Yield (path, member, data) for the wanted paths, using the index when there is one"""
+        index = self._load_index(backup_path)
+        if index is not None:
+            for path, member in index['members'].items():
+                if not wanted(path):
+                    continue
+                if 'link' in member:
+                    yield path, member, None
+                elif 'chunks' in member:
+                    yield path, member, self._open_chunks(member['chunks']).read()
+                else:
+                    yield path, member, self._read_indexed_member(backup_path, index, member)
+            return
 
+        logging.info("[cyco-backup] No index for " + os.path.basename(backup_path) + ", reading the whole archive")
+        with self._open_archive_stream(backup_path) as tar:
+            for info in tar:
+                path = '/' + info.name.lstrip('/')
+                if not wanted(path):
+                    continue
+                if info.issym():
+                    yield path, {'link': info.linkname, 'mode': info.mode, 'mtime': info.mtime}, None
+                elif info.isreg():
+                    data = tar.extractfile(info).read()
+                    yield path, {'size': info.size, 'mode': info.mode, 'mtime': info.mtime,
+                                 'sha256': hashlib.sha256(data).hexdigest()}, data
+
+    def _iter_manifest_members(self, manifest_path, wanted):
+        for entry in self._load_manifest(manifest_path)['entries']:
+            if not wanted(entry['path']) or entry['type'] == 'dir':
+                continue
+            member = {'mode': entry['mode'] & 0o7777, 'mtime': entry['mtime']}
+            if entry['type'] == 'symlink':
+                member['link'] = entry['target']
+                yield entry['path'], member, None
+            else:
+                data = self._open_chunks(entry['chunks']).read()
+                member['size'] = entry['size']
+                member['sha256'] = hashlib.sha256(data).hexdigest()
+                yield entry['path'], member, data
+
+    def _restore_member(self, path, member, data):
+        target = os.path.join(self.options['restore_root'], path.lstrip('/'))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if 'link' in member:
+            if os.path.lexists(target):
+                os.remove(target)
+            os.symlink(member['link'], target)
+            return target
+        if 'sha256' in member and hashlib.sha256(data).hexdigest() != member['sha256']:
+            raise IOError("checksum mismatch for " + path)
+        with open(target + '.restore', 'wb') as f:
+            f.write(data)
+        os.chmod(target + '.restore', member['mode'] & 0o7777)
+        os.utime(target + '.restore', (member['mtime'], member['mtime']))
+        os.replace(target + '.restore', target)
+        return target
+
+    def _restore_backup(self, filename, request):
+        """Restore single paths: /plugins/cyco-backup/restore/<backup>?path=/etc/pwnagotchi/config.toml
+
+        A path ending in / restores everything below it.
+        """
+        filename = filename.strip('/ ')
+        if '..' in filename or '/' in filename or filename == '':
+            return self._json_response({'error': 'invalid filename'}, status=400)
+        backup_path = os.path.join(self.options['backup_path'], filename)
+        if not os.path.isfile(backup_path):
+            return self._json_response({'error': 'backup not found'}, status=404)
+
+        paths = request.args.getlist('path') if request is not None else []
+        if not paths:
+            return self._json_response({'error': 'missing path parameter'}, status=400)
+        for path in paths:
+            if not path.startswith('/') or '..' in path.split('/'):
+                return self._json_response({'error': 'invalid path ' + path}, status=400)
+
+        def wanted(candidate):
+            return any(candidate == p or (p.endswith('/') and candidate.startswith(p)) for p in paths)
+
+        started = time.time()
+        restored = []
+        try:
+            if filename.endswith(MANIFEST_SUFFIX):
+                members = self._iter_manifest_members(backup_path, wanted)
+            else:
+                members = self._iter_archive_members(backup_path, wanted)
+            for path, member, data in members:
+                restored.append(self._restore_member(path, member, data))
         except Exception as e:
-            logging.error("[cyco-backup] Backup failed: " + str(e), exc_info=True)
+            logging.error("[cyco-backup] Restore from " + filename + " failed: " + str(e), exc_info=True)
+            return self._json_response({'error': str(e), 'restored': restored}, status=500)
+
+        elapsed_ms = round((time.time() - started) * 1000, 1)
+        logging.info("[cyco-backup] Restored " + str(len(restored)) + " files from " + filename + " in " + str(elapsed_ms) + " ms")
+        if not restored:
+            return self._json_response({'error': 'path not in backup', 'restored': []}, status=404)
+        return self._json_response({'backup': filename, 'restored': restored, 'elapsed_ms': elapsed_ms})
+
+    def _retention_plan(self, pwnagotchi_name):
+        """Split the catalog records of this unit into (keep, prune) lists of (record, reason)
+
+        A backup is kept when it is one of the newest max_backups or the newest one of one of
+        the last keep_hourly hours, keep_daily days or keep_weekly weeks. If the kept backups
+        still add up to more than max_total_mb the oldest ones go too, the newest always stays.
+        """
+        records = [r for r in self._catalog_records() if r['filename'].startswith(pwnagotchi_name)]
+        reasons = {}
+        for record in records[:int(self.options['max_backups'])]:
+            reasons[record['filename']] = 'last'
+        tiers = (('hourly', '%Y-%m-%d %H'), ('daily', '%Y-%m-%d'), ('weekly', '%G-%V'))
+        for tier, bucket_format in tiers:
+            count = int(self.options['keep_' + tier])
+            buckets = set()
+            for record in records:
+                if len(buckets) >= count:
+                    break
+                bucket = datetime.fromtimestamp(record['created']).strftime(bucket_format)
+                if bucket not in buckets:
+                    buckets.add(bucket)
+                    reasons.setdefault(record['filename'], tier)
+
+        keep = [(r, reasons[r['filename']]) for r in records if r['filename'] in reasons]
+        prune = [(r, 'outside retention') for r in records if r['filename'] not in reasons]
+        budget = float(self.options['max_total_mb']) * 1024 * 1024
+        if budget > 0:
+            # Chunks shared between backups count once, and only stop counting when the last one using them goes
+            footprints, sizes = self._backup_footprints([r for r, _ in keep])
+            refs = collections.Counter()
+            total = 0
+            for record, _ in keep:
+                own, digests = footprints[record['filename']]
+                total += own
+                for digest in digests:
+                    if not refs[digest]:
+                        total += sizes[digest]
+                    refs[digest] += 1
+            while total > budget and len(keep) > 1:
+                record, _ = keep.pop()
+                own, digests = footprints[record['filename']]
+                total -= own
+                for digest in digests:
+                    refs[digest] -= 1
+                    if not refs[digest]:
+                        total -= sizes[digest]
+                prune.append((record, 'over budget'))
+        return keep, prune
+
+    def _backup_footprints(self, records):
+        """filename -> (bytes of its own files, digests of the chunks it references), and digest -> chunk size
+
+        The catalog size of a backup only counts the chunks it wrote itself, so disk use is worked out here.
+        """
+        footprints = {}
+        sizes = {}
+        for record in records:
+            backup_path = os.path.join(self.options['backup_path'], record['filename'])
+            own = 0
+            for path in (backup_path, backup_path + INDEX_SUFFIX):
+                if os.path.exists(path):
+                    own += os.path.getsize(path)
+            digests = set()
+            try:
+                if backup_path.endswith(MANIFEST_SUFFIX):
+                    entries = self._load_manifest(backup_path)['entries']
+                else:
+                    index = self._load_index(backup_path)
+                    entries = index['members'].values() if index is not None else []
+                for entry in entries:
+                    digests.update(entry.get('chunks', []))
+            except (IOError, OSError, ValueError, KeyError) as e:
+                logging.warning("[cyco-backup] Could not read chunks of " + record['filename'] + ": " + str(e))
+            for digest in digests:
+                if digest not in sizes:
+                    try:
+                        sizes[digest] = os.path.getsize(self._chunk_path(digest))
+                    except OSError:
+                        sizes[digest] = 0
+            footprints[record['filename']] = (own, digests)
+        return footprints, sizes
+
+    def _retention_summary(self):
+        policy = "last " + str(self.options['max_backups'])
+        for tier in ('hourly', 'daily', 'weekly'):
+            if int(self.options['keep_' + tier]):
+                policy += ", " + str(self.options['keep_' + tier]) + " " + tier
+        keep, prune = self._retention_plan(self._get_name())
+        footprints, sizes = self._backup_footprints([r for r, _ in keep + prune])
+        chunks = set()
+        for own, digests in footprints.values():
+            chunks |= digests
+        used = (sum(own for own, _ in footprints.values()) + sum(sizes[d] for d in chunks)) / (1024 * 1024)
+        summary = "<p><strong>Retention:</strong> " + policy + " (" + str(round(used, 2)) + " MB"
+        if float(self.options['max_total_mb']) > 0:
+            summary += " of " + str(self.options['max_total_mb']) + " MB"
+        summary += ")</p>"
+        if prune:
+            summary += "<p><strong>Next cleanup removes:</strong> " + \
+                       ', '.join(r['filename'] + " (" + reason + ")" for r, reason in prune[:10])
+            if len(prune) > 10:
+                summary += " and " + str(len(prune) - 10) + " more"
+            summary += "</p>"
+        return summary
 
     def _cleanup_old_backups(self, pwnagotchi_name):
         try:
-            backup_files = []
-            for filename in os.listdir(self.options['backup_path']):
-                if filename.startswith(pwnagotchi_name) and (filename.endswith('.tar.gz') or filename.endswith('.tgz')):
-                    filepath = os.path.join(self.options['backup_path'], filename)
-                    backup_files.append((filepath, os.path.getmtime(filepath)))
-
-            backup_files.sort(key=lambda x: x[1], reverse=True)
+            removed = False
+            for record, reason in self._retention_plan(pwnagotchi_name)[1]:
+                self._remove_backup_files(os.path.join(self.options['backup_path'], record['filename']))
+                removed = True
+                logging.info("[cyco-backup] Removed old backup " + record['filename'] + " (" + reason + ")")
 
-            for filepath, _ in backup_files[int(self.options['max_backups']):]:
-                os.remove(filepath)
-                logging.info("[cyco-backup] Removed old backup")
+            if removed or self.gc_pending:
+                self.gc_pending = False
+                self._gc_chunks()
 
         except Exception as e:
             logging.error("[cyco-backup] Cleanup failed: " + str(e))
 
     def on_unload(self, ui):
+        self._cancel_job()
+        self.job_queue.put(None)
+        self.verify_stop.set()
         logging.info("[cyco-backup] Plugin unloaded")
@@ -3,12 +3,783 @@ import os
 import subprocess
 import json
 import time
+import socket
+import struct
+import threading
+import queue
+import collections
+import sqlite3
+import sys
+import re
+import csv
+import mmap
+import array
+import bisect
+import html
+import urllib.parse
 import pwnagotchi.plugins as plugins
 import pwnagotchi.ui.fonts as fonts
 from pwnagotchi.ui.components import LabeledValue
 from pwnagotchi.ui.view import BLACK
 from datetime import datetime
 
+try:
+    from flask import render_template_string, Response
+except ImportError:
+    logging.error("[cyco-btsniffer] Failed to import Flask components")
+    render_template_string = None
+    Response = None
+
+# One inquiry result: class is formatted like hcitool does it ('0x5a020c'), rssi and name may be None
+_Sighting = collections.namedtuple('_Sighting', ['mac', 'device_class', 'rssi', 'name', 'time'])
+
+# What the display shows, replaced as a whole by the scanner thread after every scan
+_Snapshot = collections.namedtuple('_Snapshot', ['devices', 'known', 'last_scan', 'last_new', 'flushes'])
+
+# HCI constants, not every python build exposes them in the socket module
+AF_BLUETOOTH = getattr(socket, 'AF_BLUETOOTH', 31)
+BTPROTO_HCI = getattr(socket, 'BTPROTO_HCI', 1)
+SOL_HCI = getattr(socket, 'SOL_HCI', 0)
+HCI_FILTER = getattr(socket, 'HCI_FILTER', 2)
+HCI_COMMAND_PKT = 0x01
+HCI_EVENT_PKT = 0x04
+EVT_INQUIRY_COMPLETE = 0x01
+EVT_INQUIRY_RESULT = 0x02
+EVT_CMD_COMPLETE = 0x0E
+EVT_CMD_STATUS = 0x0F
+EVT_INQUIRY_RESULT_WITH_RSSI = 0x22
+EVT_EXTENDED_INQUIRY_RESULT = 0x2F
+OCF_INQUIRY = 0x0401
+OCF_PERIODIC_INQUIRY = 0x0403
+OCF_EXIT_PERIODIC_INQUIRY = 0x0404
+GIAC_LAP = b'\x33\x8b\x9e'
+
+TIME_FORMAT = '%H:%M:%S %d-%m-%Y'
+DATABASE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS devices (
+    mac TEXT PRIMARY KEY,
+    name TEXT,
+    count INTEGER,
+    class TEXT,
+    manufacturer TEXT,
+    first_seen INTEGER,
+    last_seen INTEGER,
+    new_info INTEGER,
+    history BLOB,
+    hours BLOB,
+    days BLOB
+);
+CREATE INDEX IF NOT EXISTS devices_last_seen ON devices (last_seen);
+CREATE INDEX IF NOT EXISTS devices_manufacturer ON devices (manufacturer);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+DEVICE_UPSERT = "INSERT OR REPLACE INTO devices VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+# Sighting history aggregates: one bit per hour of the week, and one bit per day for the last HISTORY_DAYS days
+HISTORY_HOURS = 7 * 24
+HISTORY_DAYS = 128
+
+
+def _format_mac(raw):
+    return ':'.join('%02X' % b for b in reversed(raw))
+
+
+def _parse_eir_name(eir):
+    """Return the (complete or shortened) local name from extended inquiry response data"""
+    i = 0
+    name = None
+    while i < len(eir):
+        length = eir[i]
+        if length == 0 or i + 1 + length > len(eir):
+            break
+        field_type = eir[i + 1]
+        if field_type in (0x08, 0x09):
+            name = eir[i + 2:i + 1 + length].decode('utf-8', 'replace').strip('\x00') or None
+            if field_type == 0x09:
+                break
+        i += 1 + length
+    return name
+
+
+def _parse_hci_event(packet, now=None):
+    """Turn one raw HCI event packet into a list of Sightings (empty for other events)"""
+    now = now or time.time()
+    if len(packet) < 4 or packet[0] != HCI_EVENT_PKT:
+        return []
+    event, params = packet[1], packet[3:3 + packet[2]]
+    if event not in (EVT_INQUIRY_RESULT, EVT_INQUIRY_RESULT_WITH_RSSI, EVT_EXTENDED_INQUIRY_RESULT) or not params:
+        return []
+    count = params[0]
+    body = params[1:]
+    # Results are stored as one array per field: all addresses first, then all page scan modes, ...
+    if event == EVT_INQUIRY_RESULT:
+        fields = (('mac', 6), ('psrm', 1), ('reserved', 2), ('class', 3), ('clock', 2))
+    else:
+        fields = (('mac', 6), ('psrm', 1), ('reserved', 1), ('class', 3), ('clock', 2), ('rssi', 1))
+    offset = 0
+    arrays = {}
+    for field, size in fields:
+        arrays[field] = [body[offset + n * size:offset + (n + 1) * size] for n in range(count)]
+        offset += size * count
+    if offset > len(body):
+        return []
+    sightings = []
+    for n in range(count):
+        rssi = None
+        if 'rssi' in arrays:
+            rssi = struct.unpack('b', arrays['rssi'][n])[0]
+        name = _parse_eir_name(body[offset:]) if event == EVT_EXTENDED_INQUIRY_RESULT else None
+        sightings.append(_Sighting(_format_mac(arrays['mac'][n]), '0x%06x' % int.from_bytes(arrays['class'][n], 'little'),
+                                  rssi, name, now))
+    return sightings
+
+
+class _HciSocketBackend(object):
+    """Discovery through a raw HCI socket, keeping the controller in periodic inquiry mode
+
+    sock can be any object with send/recv/settimeout/close, which is how a fake HCI event
+    stream is plugged in.
+    """
+    name = 'hci-socket'
+
+    def __init__(self, device=0, inquiry_length=8, sock=None):
+        self.device = device
+        self.inquiry_length = inquiry_length
+        self.sock = sock
+        self.periodic = True
+        # Seconds between inquiries, None runs them back to back
+        self.period = None
+        self.started = 0
+        self.pending = False
+
+    def open(self):
+        if self.sock is None:
+            sock = socket.socket(AF_BLUETOOTH, socket.SOCK_RAW, BTPROTO_HCI)
+            try:
+                sock.bind((self.device,))
+                events = [EVT_INQUIRY_COMPLETE, EVT_INQUIRY_RESULT, EVT_CMD_COMPLETE, EVT_CMD_STATUS,
+                          EVT_INQUIRY_RESULT_WITH_RSSI, EVT_EXTENDED_INQUIRY_RESULT]
+                mask = sum(1 << e for e in events)
+                sock.setsockopt(SOL_HCI, HCI_FILTER,
+                                struct.pack('<IIIH', 1 << HCI_EVENT_PKT, mask & 0xffffffff, mask >> 32, 0))
+            except Exception:
+                sock.close()
+                raise
+            self.sock = sock
+        self.sock.settimeout(1.0)
+        self._command(OCF_EXIT_PERIODIC_INQUIRY)
+        self._start_inquiry()
+
+    def _command(self, opcode, params=b''):
+        self.sock.send(struct.pack('<BHB', HCI_COMMAND_PKT, opcode, len(params)) + params)
+
+    def _start_inquiry(self):
+        length = self.inquiry_length
+        self.started = time.time()
+        self.pending = False
+        if self.periodic:
+            # Periods are in units of 1.28s, the controller picks a random one between min and max
+            minimum = length + 1
+            if self.period:
+                minimum = min(0xfffe, max(minimum, int(self.period / 1.28)))
+            self._command(OCF_PERIODIC_INQUIRY, struct.pack('<HH', minimum + 1, minimum) + GIAC_LAP + bytes([length, 0]))
+        else:
+            self._command(OCF_INQUIRY, GIAC_LAP + bytes([length, 0]))
+
+    def set_period(self, period):
+        """Change the time between inquiries, a running periodic inquiry is restarted with the new period"""
+        if period == self.period:
+            return
+        self.period = period
+        if self.sock is not None and self.periodic:
+            self._command(OCF_EXIT_PERIODIC_INQUIRY)
+            self._start_inquiry()
+
+    def events(self, stop):
+        while not stop.is_set():
+            try:
+                packet = self.sock.recv(260)
+            except socket.timeout:
+                packet = None
+            if self.pending and time.time() >= self.started + (self.period or 0):
+                self._start_inquiry()
+            if packet is None:
+                continue
+            if not packet:
+                raise IOError("HCI socket closed")
+            if len(packet) >= 7 and packet[0] == HCI_EVENT_PKT and packet[1] == EVT_CMD_COMPLETE and \
+                    struct.unpack('<H', packet[4:6])[0] == OCF_PERIODIC_INQUIRY and packet[6] != 0:
+                # Periodic inquiry is optional for controllers, restart a normal inquiry after each one instead
+                logging.info("[cyco-btsniffer] Periodic inquiry not supported, falling back to single inquiries")
+                self.periodic = False
+                self._start_inquiry()
+            elif len(packet) >= 2 and packet[0] == HCI_EVENT_PKT and packet[1] == EVT_INQUIRY_COMPLETE and not self.periodic:
+                self.pending = True
+                if time.time() >= self.started + (self.period or 0):
+                    self._start_inquiry()
+            for sighting in _parse_hci_event(packet):
+                yield sighting
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self._command(OCF_EXIT_PERIODIC_INQUIRY)
+            except Exception:
+                pass
+            self.sock.close()
+            self.sock = None
+
+
+class _HcitoolBackend(object):
+    """Fallback when raw HCI sockets are not available: back to back `hcitool inq` runs"""
+    name = 'hcitool'
+
+    def __init__(self):
+        self.process = None
+        self.period = None
+
+    def open(self):
+        subprocess.check_output(['hcitool', 'dev'])
+
+    def set_period(self, period):
+        self.period = period
+
+    def events(self, stop):
+        while not stop.is_set():
+            started = time.time()
+            self.process = subprocess.Popen(['hcitool', 'inq', '--flush'], stdout=subprocess.PIPE,
+                                            stderr=subprocess.DEVNULL)
+            for line in self.process.stdout:
+                sighting = self.parse_line(line)
+                if sighting is not None:
+                    yield sighting
+            if self.process.wait() != 0:
+                raise IOError("hcitool inq exited with %d" % self.process.returncode)
+            if self.period:
+                stop.wait(max(0, started + self.period - time.time()))
+
+    @staticmethod
+    def parse_line(line):
+        fields = line.split()
+        if not fields or fields[0].count(b':') != 5:
+            return None
+        device_class = None
+        for i in range(len(fields)):
+            if fields[i] == b'class:' and i + 1 < len(fields):
+                device_class = fields[i + 1].decode()
+        return _Sighting(fields[0].decode(), device_class, None, None, time.time())
+
+    def close(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+
+class _DiscoveryEngine(object):
+    """Keeps one discovery session open on a background thread and streams sightings into a queue
+
+    backends are tried in order, a backend that cannot be opened is dropped for the next one.
+    """
+
+    def __init__(self, backends, maxsize=1024, retry=10):
+        self.backends = list(backends)
+        self.sightings = queue.Queue(maxsize=maxsize)
+        self.retry = retry
+        self.dropped = 0
+        self.backend = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='cyco-btsniffer-discovery')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        backend = self.backend
+        if backend is not None:
+            backend.close()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def set_period(self, period):
+        """Seconds between inquiries for every backend, None for back to back inquiries"""
+        for backend in self.backends:
+            try:
+                backend.set_period(period)
+            except Exception as e:
+                logging.debug(f"[cyco-btsniffer] Could not change {backend.name} inquiry period: {e}")
+
+    def drain(self):
+        """Return everything queued so far without blocking"""
+        sightings = []
+        while True:
+            try:
+                sightings.append(self.sightings.get_nowait())
+            except queue.Empty:
+                return sightings
+
+    def _run(self):
+        while not self._stop.is_set() and self.backends:
+            self.backend = self.backends[0]
+            try:
+                self.backend.open()
+            except Exception as e:
+                logging.warning(f"[cyco-btsniffer] {self.backend.name} discovery unavailable: {e}")
+                self.backend.close()
+                if len(self.backends) > 1:
+                    self.backends.pop(0)
+                else:
+                    self._stop.wait(self.retry)
+                continue
+            logging.info(f"[cyco-btsniffer] Discovery running on {self.backend.name}")
+            try:
+                for sighting in self.backend.events(self._stop):
+                    try:
+                        self.sightings.put_nowait(sighting)
+                    except queue.Full:
+                        self.dropped += 1
+            except Exception as e:
+                if not self._stop.is_set():
+                    logging.warning(f"[cyco-btsniffer] {self.backend.name} discovery failed: {e}")
+            finally:
+                self.backend.close()
+            self._stop.wait(self.retry)
+
+
+class _ScanScheduler(object):
+    """Adaptive scan interval between minimum and maximum seconds
+
+    New devices bring the interval straight down to minimum, changed devices divide it by backoff and a scan
+    without either multiplies it by backoff. The last window scans are kept for the scan rate statistics.
+    """
+
+    def __init__(self, interval, minimum, maximum, backoff=2.0, window=20):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.backoff = max(1.0, backoff)
+        self.interval = min(self.maximum, max(self.minimum, interval))
+        # (time, new devices) of the last scans
+        self.scans = collections.deque(maxlen=window)
+
+    def update(self, now, new, changed):
+        self.scans.append((now, new))
+        if new:
+            self.interval = self.minimum
+        elif changed:
+            self.interval = max(self.minimum, self.interval / self.backoff)
+        else:
+            self.interval = min(self.maximum, self.interval * self.backoff)
+        return self.interval
+
+    def scans_per_hour(self):
+        if len(self.scans) < 2 or self.scans[-1][0] <= self.scans[0][0]:
+            return 0.0
+        return (len(self.scans) - 1) * 3600.0 / (self.scans[-1][0] - self.scans[0][0])
+
+    def new_per_scan(self):
+        return sum(new for when, new in self.scans) / float(len(self.scans)) if self.scans else 0.0
+
+    def as_dict(self):
+        return {'interval': round(self.interval, 1), 'scans_per_hour': round(self.scans_per_hour(), 1),
+                'new_per_scan': round(self.new_per_scan(), 2)}
+
+
+def _parse_time(value):
+    """Epoch seconds from a devices_file timestamp, older files store them as formatted strings"""
+    if isinstance(value, (int, float)):
+        return int(value)
+    return int(datetime.strptime(value, TIME_FORMAT).timestamp())
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def _format_time(value):
+    return time.strftime(TIME_FORMAT, time.localtime(value))
+
+
+def _week_hour(value):
+    """Hour of the week (0 is monday 00:00-00:59, local time) of an epoch timestamp"""
+    local = time.localtime(value)
+    return local.tm_wday * 24 + local.tm_hour
+
+
+def _day_number(value):
+    return datetime.fromtimestamp(value).toordinal()
+
+
+def _bitmap_bytes(value, bits):
+    return value.to_bytes((bits + 7) // 8, 'big') if value else None
+
+
+class _Device(object):
+    """One bluetooth device, timestamps are epoch seconds and only formatted when written to JSON
+
+    history holds the epoch seconds of the last sightings (at most history_size, oldest first), hours has
+    bit n set when the device was seen in hour n of the week and days has bit n set when it was seen n days
+    before its last sighting. All three have a fixed maximum size however long the device stays around.
+    """
+    __slots__ = ('name', 'count', 'device_class', 'manufacturer', 'first_seen', 'last_seen', 'new_info',
+                 'history', 'hours', 'days')
+
+    def __init__(self, name, count, device_class, manufacturer, first_seen, last_seen, new_info,
+                 history=None, hours=0, days=0):
+        self.name = name
+        self.count = count
+        # Classes and manufacturers repeat a lot, interning shares one string between all devices
+        self.device_class = _intern(device_class)
+        self.manufacturer = _intern(manufacturer)
+        self.first_seen = first_seen
+        self.last_seen = last_seen
+        self.new_info = new_info
+        self.history = history
+        self.hours = hours
+        self.days = days
+
+    @property
+    def known(self):
+        return self.name != 'Unknown' and self.manufacturer != 'Unknown'
+
+    @property
+    def days_seen(self):
+        """Number of different days the device was seen on, within HISTORY_DAYS of its last sighting"""
+        return bin(self.days).count('1')
+
+    def seen_at(self, when):
+        """True when the device was ever seen in the same hour of the week as the epoch timestamp when"""
+        return bool(self.hours >> _week_hour(when) & 1)
+
+    def record(self, when, size, resolution):
+        """Add a sighting to the history, returns False when the last one is less than resolution seconds ago"""
+        when = int(when)
+        history = self.history
+        if history:
+            if when - history[-1] < resolution:
+                return False
+            shift = _day_number(when) - _day_number(history[-1])
+            self.days = (self.days << shift) & ((1 << HISTORY_DAYS) - 1) if shift < HISTORY_DAYS else 0
+        else:
+            history = self.history = array.array('I')
+        history.append(when)
+        if len(history) > size:
+            del history[:len(history) - size]
+        self.days |= 1
+        self.hours |= 1 << _week_hour(when)
+        return True
+
+    @classmethod
+    def from_json(cls, record):
+        history = None
+        if record.get('history'):
+            # Stored as the first timestamp followed by the seconds between sightings
+            history = array.array('I', record['history'])
+            for n in range(1, len(history)):
+                history[n] += history[n - 1]
+        return cls(record['name'], record['count'], record['class'], record['manufacturer'],
+                   _parse_time(record['first_seen']), _parse_time(record['last_seen']), record['new_info'],
+                   history, int(record.get('hours', '0'), 16), int(record.get('days', '0'), 16))
+
+    def to_json(self):
+        record = {'name': self.name, 'count': self.count, 'class': self.device_class, 'manufacturer': self.manufacturer,
+                  'first_seen': _format_time(self.first_seen), 'last_seen': _format_time(self.last_seen),
+                  'new_info': self.new_info}
+        if self.history:
+            history = self.history
+            record['history'] = [history[0]] + [history[n] - history[n - 1] for n in range(1, len(history))]
+            record['hours'] = '%x' % self.hours
+            record['days'] = '%x' % self.days
+        return record
+
+    @classmethod
+    def from_row(cls, row):
+        """From a devices table row (without the mac), the history columns are optional"""
+        name, count, device_class, manufacturer, first_seen, last_seen, new_info = row[:7]
+        history, hours, days = row[7:10] if len(row) > 7 else (None, None, None)
+        if history:
+            history = array.array('I', history)
+        return cls(name, count, device_class, manufacturer, first_seen, last_seen, True if new_info == 1 else new_info,
+                   history or None, int.from_bytes(hours or b'', 'big'), int.from_bytes(days or b'', 'big'))
+
+    def to_row(self, mac_address):
+        return (mac_address, self.name, self.count, self.device_class, self.manufacturer,
+                self.first_seen, self.last_seen, int(self.new_info),
+                self.history.tobytes() if self.history else None,
+                _bitmap_bytes(self.hours, HISTORY_HOURS), _bitmap_bytes(self.days, HISTORY_DAYS))
+
+
+class _DeviceCounters(object):
+    """Running totals over all devices, kept up to date as devices are added or change
+
+    Callers remove() a device before changing it and add() it again afterwards.
+    """
+
+    def __init__(self):
+        self.total = 0
+        self.known = 0
+        self.by_manufacturer = collections.Counter()
+        self.by_class = collections.Counter()
+
+    @property
+    def unknown(self):
+        return self.total - self.known
+
+    def add(self, device):
+        self.total += 1
+        self.known += device.known
+        self.by_manufacturer[device.manufacturer] += 1
+        self.by_class[device.device_class] += 1
+
+    def remove(self, device):
+        self.total -= 1
+        self.known -= device.known
+        for counter, key in ((self.by_manufacturer, device.manufacturer), (self.by_class, device.device_class)):
+            counter[key] -= 1
+            if counter[key] <= 0:
+                del counter[key]
+
+    def as_dict(self):
+        return {'total': self.total, 'known': self.known, 'unknown': self.unknown,
+                'manufacturers': dict(self.by_manufacturer), 'classes': dict(self.by_class)}
+
+
+class _DeviceIndex(object):
+    """Secondary indexes over the devices in memory, so the webhook does not walk every device for a query
+
+    Like with _DeviceCounters, callers remove() a device before changing it and add() it again afterwards.
+    """
+
+    def __init__(self):
+        self.by_manufacturer = collections.defaultdict(set)
+        self.by_class = collections.defaultdict(set)
+        self.by_count = collections.defaultdict(set)
+        # (last_seen, mac) pairs, kept sorted
+        self.by_last_seen = []
+
+    def add(self, mac_address, device):
+        self.by_manufacturer[device.manufacturer].add(mac_address)
+        self.by_class[device.device_class].add(mac_address)
+        self.by_count[device.count].add(mac_address)
+        bisect.insort(self.by_last_seen, (device.last_seen, mac_address))
+
+    def remove(self, mac_address, device):
+        for index, key in ((self.by_manufacturer, device.manufacturer), (self.by_class, device.device_class),
+                           (self.by_count, device.count)):
+            index[key].discard(mac_address)
+            if not index[key]:
+                del index[key]
+        i = bisect.bisect_left(self.by_last_seen, (device.last_seen, mac_address))
+        if i < len(self.by_last_seen) and self.by_last_seen[i] == (device.last_seen, mac_address):
+            del self.by_last_seen[i]
+
+    def query(self, devices, manufacturer=None, device_class=None, name=None, since=None, min_count=None):
+        """MACs of the devices matching every given filter, most recently seen first"""
+        sets = []
+        if manufacturer is not None:
+            sets.append(self.by_manufacturer.get(manufacturer, set()))
+        if device_class is not None:
+            sets.append(self.by_class.get(device_class, set()))
+        if min_count is not None:
+            sets.append(set().union(*[macs for count, macs in self.by_count.items() if count >= min_count]))
+        name = name.lower() if name else None
+        if sets:
+            # Start from the smallest set, everything else is checked per device
+            sets.sort(key=len)
+            found = []
+            for mac_address in sets[0]:
+                device = devices[mac_address]
+                if all(mac_address in macs for macs in sets[1:]) and (since is None or device.last_seen >= since) and \
+                        (name is None or name in device.name.lower()):
+                    found.append((device.last_seen, mac_address))
+            found.sort(reverse=True)
+            return [mac_address for last_seen, mac_address in found]
+        start = bisect.bisect_left(self.by_last_seen, (since,)) if since is not None else 0
+        return [mac_address for last_seen, mac_address in reversed(self.by_last_seen[start:])
+                if name is None or name in devices[mac_address].name.lower()]
+
+
+def _device_matches(device, filters):
+    """The webhook filters applied to one device, for devices not in the database yet and the history filters"""
+    name = filters.get('name')
+    return (filters.get('manufacturer') is None or device.manufacturer == filters['manufacturer']) and \
+        (filters.get('device_class') is None or device.device_class == filters['device_class']) and \
+        (filters.get('since') is None or device.last_seen >= filters['since']) and \
+        (filters.get('min_count') is None or device.count >= filters['min_count']) and \
+        (not name or name.lower() in device.name.lower()) and \
+        (filters.get('min_days') is None or device.days_seen >= filters['min_days']) and \
+        (filters.get('at') is None or device.seen_at(filters['at']))
+
+
+def _write_devices_json(f, devices):
+    """Write (mac, _Device) pairs as the devices_file JSON object, one device per line"""
+    f.write('{')
+    separator = '\n'
+    for mac_address, device in devices:
+        f.write(separator + '  ' + json.dumps(mac_address) + ': ' + json.dumps(device.to_json()))
+        separator = ',\n'
+    f.write('\n}\n')
+
+
+OUI_MAGIC = b'OUI1'
+OUI_RECORD = struct.Struct('>II')
+OUI_TXT_LINE = re.compile(r'^([0-9A-Fa-f]{2})[-:]([0-9A-Fa-f]{2})[-:]([0-9A-Fa-f]{2})\s+\(hex\)\s+(.+)$')
+
+
+def _read_oui_source(path):
+    """Yield (prefix, vendor) from the IEEE oui.txt or oui.csv, or a Wireshark manuf file"""
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        if path.endswith('.csv'):
+            for row in csv.reader(f):
+                if len(row) >= 3 and row[0] == 'MA-L' and len(row[1]) == 6:
+                    yield int(row[1], 16), row[2].strip()
+            return
+        for line in f:
+            match = OUI_TXT_LINE.match(line)
+            if match:
+                yield int(''.join(match.group(1, 2, 3)), 16), match.group(4).strip()
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) >= 2 and len(fields[0]) == 8 and fields[0].count(':') == 2:
+                try:
+                    yield int(fields[0].replace(':', ''), 16), (fields[2] if len(fields) > 2 else fields[1]).strip()
+                except ValueError:
+                    pass
+
+
+class _OuiTable(object):
+    """Memory-mapped vendor table: sorted (prefix, name offset) records followed by the vendor names
+
+    Built once from a copy of the IEEE OUI registry and rebuilt when the source changes.
+    Lookups are a binary search over the mapped records and never touch the radio.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:4] != OUI_MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not an OUI table")
+        self.count = struct.unpack_from('>I', self._map, 4)[0]
+        self._names = 8 + self.count * OUI_RECORD.size
+
+    @staticmethod
+    def build(source, path):
+        vendors = {}
+        for prefix, vendor in _read_oui_source(source):
+            vendors[prefix] = vendor
+        names = bytearray()
+        offsets = {}
+        records = []
+        for prefix in sorted(vendors):
+            vendor = vendors[prefix].encode('utf-8')
+            if vendor not in offsets:
+                offsets[vendor] = len(names)
+                names += vendor + b'\x00'
+            records.append(OUI_RECORD.pack(prefix, offsets[vendor]))
+        with open(path + '.tmp', 'wb') as f:
+            f.write(OUI_MAGIC + struct.pack('>I', len(records)))
+            f.write(b''.join(records))
+            f.write(names)
+        os.replace(path + '.tmp', path)
+        return len(records)
+
+    def lookup(self, mac_address):
+        """Vendor name for a MAC address, None for unknown prefixes and locally administered addresses"""
+        try:
+            prefix = int(mac_address.replace(':', '').replace('-', '')[:6], 16)
+        except ValueError:
+            return None
+        if prefix & 0x020000:
+            return None
+        low, high = 0, self.count - 1
+        while low <= high:
+            middle = (low + high) // 2
+            key, offset = OUI_RECORD.unpack_from(self._map, 8 + middle * OUI_RECORD.size)
+            if key < prefix:
+                low = middle + 1
+            elif key > prefix:
+                high = middle - 1
+            else:
+                start = self._names + offset
+                return self._map[start:self._map.find(b'\x00', start)].decode('utf-8', 'replace')
+        return None
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+class _ResolverPool(object):
+    """Worker threads that look up device names and manufacturers off the scan path
+
+    Lookups go through a bounded queue, a lookup that is already queued is not queued twice and
+    one that came back 'Unknown' is not retried until negative_ttl seconds have passed.
+    on_result(mac, kind, value) is called from the worker thread for every successful lookup.
+    """
+
+    def __init__(self, lookups, on_result, workers=2, maxsize=64, negative_ttl=3600):
+        self.lookups = lookups
+        self.on_result = on_result
+        self.negative_ttl = negative_ttl
+        self.jobs = queue.Queue(maxsize=maxsize)
+        self.pending = set()
+        self.negative = {}
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self._threads = []
+        for i in range(max(1, workers)):
+            thread = threading.Thread(target=self._work, name='cyco-btsniffer-resolver-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, mac, kind):
+        """Queue a lookup, returns False when it is cached as unanswered, already queued or the queue is full"""
+        key = (mac, kind)
+        now = time.time()
+        with self.lock:
+            if key in self.pending or self.negative.get(key, 0) > now:
+                return False
+            if len(self.negative) > 4096:
+                self.negative = dict((k, v) for k, v in self.negative.items() if v > now)
+            try:
+                self.jobs.put_nowait(key)
+            except queue.Full:
+                self.dropped += 1
+                return False
+            self.pending.add(key)
+        return True
+
+    def stop(self):
+        for _ in self._threads:
+            try:
+                self.jobs.put_nowait(None)
+            except queue.Full:
+                break
+
+    def _work(self):
+        while True:
+            key = self.jobs.get()
+            if key is None:
+                return
+            mac, kind = key
+            try:
+                value = self.lookups[kind](mac)
+            except Exception as e:
+                logging.info(f"[cyco-btsniffer] {kind} lookup for {mac} failed: {e}")
+                value = 'Unknown'
+            with self.lock:
+                self.pending.discard(key)
+                if value == 'Unknown':
+                    self.negative[key] = time.time() + self.negative_ttl
+            if value != 'Unknown':
+                self.on_result(mac, kind, value)
+
+
 class CycoBtSniffer(plugins.Plugin):
     __author__ = 'diytechtinker, fixed by Jayofelony, updated by cycoslave'
     __version__ = '0.1.5'
@@ -22,10 +793,48 @@ class CycoBtSniffer(plugins.Plugin):
             'devices_file': '/root/handshakes/bluetooth_devices.json',
             'count_interval': 86400,
             'bt_x_coord': 160,
-            'bt_y_coord': 66
+            'bt_y_coord': 66,
+            'discovery_backend': 'auto',
+            'hci_device': 0,
+            'resolver_workers': 2,
+            'resolver_timeout': 7,
+            'resolver_queue': 64,
+            'negative_ttl': 3600,
+            'storage': 'json',
+            'database_file': '/root/handshakes/bluetooth_devices.db',
+            'json_export_interval': 3600,
+            'oui_file': '/usr/share/ieee-data/oui.txt',
+            'oui_table': '/root/handshakes/oui.bin',
+            'hcitool_manufacturer': True,
+            'flush_max_delay': 300,
+            'flush_max_dirty': 100,
+            'durability': 'normal',
+            'history_size': 32,
+            'history_resolution': 300,
+            'min_timer': 15,
+            'max_timer': 300,
+            'timer_backoff': 2.0,
+            'busy_window': 10,
         }
         self.data = {}
-        self.last_scan_time = 0
+        self.dirty = set()
+        self.counters = _DeviceCounters()
+        self.index = None
+        self.oui = None
+        self.db = None
+        self.last_export = 0
+        self.data_lock = threading.Lock()
+        self.snapshot = _Snapshot(0, 0, 0, None, 0)
+        self.shown_flushes = 0
+        self.flushes = 0
+        self.dirty_since = None
+        self.last_new = None
+        self.discovery = None
+        self.resolver = None
+        self.scheduler = None
+        self.busy_until = 0
+        self.scanner_stop = threading.Event()
+        self.scanner_thread = None
 
     def on_loaded(self):
         # Set defaults for any missing options
@@ -34,6 +843,27 @@ class CycoBtSniffer(plugins.Plugin):
         self.options.setdefault('count_interval', 86400)
         self.options.setdefault('bt_x_coord', 160)
         self.options.setdefault('bt_y_coord', 66)
+        self.options.setdefault('discovery_backend', 'auto')
+        self.options.setdefault('hci_device', 0)
+        self.options.setdefault('resolver_workers', 2)
+        self.options.setdefault('resolver_timeout', 7)
+        self.options.setdefault('resolver_queue', 64)
+        self.options.setdefault('negative_ttl', 3600)
+        self.options.setdefault('storage', 'json')
+        self.options.setdefault('database_file', '/root/handshakes/bluetooth_devices.db')
+        self.options.setdefault('json_export_interval', 3600)
+        self.options.setdefault('oui_file', '/usr/share/ieee-data/oui.txt')
+        self.options.setdefault('oui_table', '/root/handshakes/oui.bin')
+        self.options.setdefault('hcitool_manufacturer', True)
+        self.options.setdefault('flush_max_delay', 300)
+        self.options.setdefault('flush_max_dirty', 100)
+        self.options.setdefault('durability', 'normal')
+        self.options.setdefault('history_size', 32)
+        self.options.setdefault('history_resolution', 300)
+        self.options.setdefault('min_timer', 15)
+        self.options.setdefault('max_timer', 300)
+        self.options.setdefault('timer_backoff', 2.0)
+        self.options.setdefault('busy_window', 10)
 
         logging.info("[cyco-btsniffer] bluetoothsniffer plugin loaded.")
         logging.info("[cyco-btsniffer] Bluetooth devices file location: %s", self.options['devices_file'])
@@ -47,8 +877,212 @@ class CycoBtSniffer(plugins.Plugin):
             with open(self.options['devices_file'], 'w') as f:
                 json.dump({}, f)
 
-        # Loading the data from the device file with error handling
-        self._load_devices_file()
+        # Loading the data from the device file with error handling, the database loads devices when they are seen
+        if self.options['storage'] == 'sqlite':
+            self._open_database()
+        else:
+            self._load_devices_file()
+            self.counters = self._count_devices()
+            self.index = _DeviceIndex()
+            for mac_address, device in self.data.items():
+                self.index.add(mac_address, device)
+
+        # Manufacturers come from the local OUI table first, hcitool info is only asked when it has no answer
+        self._open_oui_table()
+
+        # Name and manufacturer lookups run on their own threads so they never hold up a scan
+        self.resolver = _ResolverPool({'name': self.get_device_name, 'manufacturer': self.get_device_manufacturer},
+                                      self._on_resolved, workers=int(self.options['resolver_workers']),
+                                      maxsize=int(self.options['resolver_queue']),
+                                      negative_ttl=float(self.options['negative_ttl']))
+
+        # Scans start every timer seconds and then adapt between min_timer and max_timer
+        self.scheduler = _ScanScheduler(float(self.options['timer']), float(self.options['min_timer']),
+                                        float(self.options['max_timer']), float(self.options['timer_backoff']))
+
+        # Starting the discovery session, it keeps running in the background until the plugin unloads and
+        # inquires about as often as the scanner scans
+        self.discovery = _DiscoveryEngine(self._discovery_backends())
+        self.discovery.set_period(self.scheduler.interval)
+        self.discovery.start()
+
+        # Scanning runs on its own thread, the display only reads the snapshot it publishes
+        self._publish_snapshot(0)
+        self.scanner_thread = threading.Thread(target=self._scanner, name='cyco-btsniffer-scanner')
+        self.scanner_thread.daemon = True
+        self.scanner_thread.start()
+
+    def _scanner(self):
+        next_scan = time.time() + self.scheduler.interval
+        while not self.scanner_stop.is_set():
+            # Scans move out of the busy moments after an agent epoch or wifi update, by at most busy_window
+            due = max(next_scan, min(self.busy_until, next_scan + float(self.options['busy_window'])))
+            if time.time() < due:
+                self.scanner_stop.wait(due - time.time())
+                continue
+            try:
+                new, changed = self.scan()
+                interval = self.scheduler.update(time.time(), new, changed)
+                self.discovery.set_period(interval)
+                logging.info("[cyco-btsniffer] Bluetooth sniffed: %s, %d new, next scan in %ds (%s)",
+                             str(self.bt_sniff_info()), new, interval, self.scheduler.as_dict())
+                if self.db is not None and time.time() - self.last_export >= float(self.options['json_export_interval']):
+                    self.flush()
+                    self.export_json()
+            except Exception as e:
+                logging.error(f"[cyco-btsniffer] Scan failed: {e}")
+            next_scan = time.time() + self.scheduler.interval
+
+    def on_epoch(self, agent, epoch, epoch_data):
+        self.busy_until = time.time() + float(self.options['busy_window'])
+
+    def on_wifi_update(self, agent, access_points):
+        self.busy_until = time.time() + float(self.options['busy_window'])
+
+    def _publish_snapshot(self, scan_time):
+        self.snapshot = _Snapshot(self.counters.total, self.counters.known, scan_time, self.last_new, self.flushes)
+
+    def _count_devices(self):
+        """Counters computed from scratch, from the database or from self.data"""
+        counters = _DeviceCounters()
+        if self.db is not None:
+            for row in self.db.execute("SELECT name, count, class, manufacturer, first_seen, last_seen, new_info FROM devices"):
+                counters.add(_Device.from_row(row))
+        else:
+            for device in self.data.values():
+                counters.add(device)
+        return counters
+
+    def check_counters(self):
+        """Recount all devices and compare with the running counters, fixing them when they drifted"""
+        if self.db is not None:
+            self.flush()
+        with self.data_lock:
+            counters = self._count_devices()
+            consistent = counters.as_dict() == self.counters.as_dict()
+            if not consistent:
+                logging.warning(f"[cyco-btsniffer] Device counters drifted: {self.counters.as_dict()} != {counters.as_dict()}")
+                self.counters = counters
+        return consistent
+
+    def regulars(self, min_days=3, when=None):
+        """MACs of devices seen on at least min_days days, most days first
+
+        With an epoch timestamp when, only devices that were seen in the same hour of the week are returned,
+        which answers "who is usually around here at this time".
+        """
+        if self.db is not None:
+            self.flush()
+        found = []
+        with self.data_lock:
+            if self.db is not None:
+                rows = self.db.execute("SELECT * FROM devices WHERE days IS NOT NULL")
+                devices = ((row[0], _Device.from_row(row[1:])) for row in rows)
+            else:
+                devices = self.data.items()
+            for mac_address, device in devices:
+                if device.days_seen >= min_days and (when is None or device.seen_at(when)):
+                    found.append((device.days_seen, mac_address))
+        found.sort(key=lambda item: (-item[0], item[1]))
+        return [mac_address for days_seen, mac_address in found]
+
+    def _index(self, mac_address, device):
+        """Count a device and add it to the webhook indexes, called with data_lock held"""
+        self.counters.add(device)
+        if self.index is not None:
+            self.index.add(mac_address, device)
+
+    def _unindex(self, mac_address, device):
+        self.counters.remove(device)
+        if self.index is not None:
+            self.index.remove(mac_address, device)
+
+    def _update_device(self, mac_address, device, field, value):
+        """Change one field of a stored device, keeping the counters in step and marking it dirty"""
+        with self.data_lock:
+            self._unindex(mac_address, device)
+            setattr(device, field, _intern(value))
+            device.new_info = 2
+            self._index(mac_address, device)
+            self.dirty.add(mac_address)
+
+    def _open_oui_table(self):
+        source, table = self.options['oui_file'], self.options['oui_table']
+        try:
+            if os.path.exists(source) and (not os.path.exists(table) or os.path.getmtime(source) > os.path.getmtime(table)):
+                count = _OuiTable.build(source, table)
+                logging.info(f"[cyco-btsniffer] Built OUI table with {count} vendors from {source}")
+            if os.path.exists(table):
+                self.oui = _OuiTable(table)
+            else:
+                logging.info(f"[cyco-btsniffer] No OUI registry at {source}, manufacturers come from hcitool only")
+        except Exception as e:
+            logging.error(f"[cyco-btsniffer] Could not load OUI table: {e}")
+
+    def _lookup_manufacturer(self, mac_address):
+        """Vendor from the OUI table, None when the table is missing or does not know the prefix"""
+        return self.oui.lookup(mac_address) if self.oui is not None else None
+
+    def _discovery_backends(self):
+        backend = self.options['discovery_backend']
+        backends = []
+        if backend in ('auto', 'socket'):
+            backends.append(_HciSocketBackend(int(self.options['hci_device'])))
+        if backend in ('auto', 'hcitool'):
+            backends.append(_HcitoolBackend())
+        if not backends:
+            logging.error(f"[cyco-btsniffer] Unknown discovery_backend {backend}, using auto")
+            backends = [_HciSocketBackend(int(self.options['hci_device'])), _HcitoolBackend()]
+        return backends
+
+    def _open_database(self):
+        """Open the SQLite device store in WAL mode, importing devices_file the first time"""
+        self.db = sqlite3.connect(self.options['database_file'], check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=' + {'none': 'OFF', 'full': 'FULL'}.get(self.options['durability'], 'NORMAL'))
+        # Devices not flushed yet, left out of webhook queries on the database (kept in memory, never on disk)
+        self.db.execute('PRAGMA temp_store=MEMORY')
+        self.db.execute('CREATE TEMP TABLE IF NOT EXISTS pending (mac TEXT PRIMARY KEY)')
+        self.db.executescript(DATABASE_SCHEMA)
+        # Databases created before the sighting history was added get its columns
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(devices)")]
+        for column in ('history', 'hours', 'days'):
+            if column not in columns:
+                self.db.execute("ALTER TABLE devices ADD COLUMN %s BLOB" % column)
+        if self.db.execute("SELECT value FROM meta WHERE key = 'migrated_from'").fetchone() is None:
+            self._load_devices_file()
+            rows = []
+            for mac, device in self.data.items():
+                rows.append(device.to_row(mac))
+            with self.db:
+                self.db.executemany(DEVICE_UPSERT, rows)
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('migrated_from', ?)", (self.options['devices_file'],))
+            logging.info(f"[cyco-btsniffer] Migrated {len(rows)} devices from {self.options['devices_file']}")
+            self.data = {}
+        self.counters = self._count_devices()
+        self.last_export = time.time()
+        logging.info(f"[cyco-btsniffer] Using device database {self.options['database_file']}")
+
+    def _get_device(self, mac_address):
+        """The device record, from memory or (with the database) loaded on first use"""
+        device = self.data.get(mac_address)
+        if device is None and self.db is not None:
+            with self.data_lock:
+                row = self.db.execute("SELECT * FROM devices WHERE mac = ?", (mac_address,)).fetchone()
+                if row is not None:
+                    device = self.data[mac_address] = _Device.from_row(row[1:])
+        return device
+
+    def export_json(self, path=None):
+        """Write the database to devices_file in the usual JSON format, one device at a time"""
+        path = path or self.options['devices_file']
+        with self.data_lock:
+            with open(path + '.tmp', 'w') as f:
+                rows = self.db.execute("SELECT * FROM devices ORDER BY mac")
+                _write_devices_json(f, ((row[0], _Device.from_row(row[1:])) for row in rows))
+            os.replace(path + '.tmp', path)
+        self.last_export = time.time()
+        logging.debug(f"[cyco-btsniffer] Exported devices to {path}")
 
     def _load_devices_file(self):
         """Load devices from JSON file with robust error handling"""
@@ -62,7 +1096,12 @@ class CycoBtSniffer(plugins.Plugin):
                     self.data = {}
                 else:
                     try:
-                        self.data = json.loads(content)
+                        self.data = {}
+                        for mac, record in json.loads(content).items():
+                            try:
+                                self.data[mac] = _Device.from_json(record)
+                            except (KeyError, TypeError, ValueError) as e:
+                                logging.warning(f"[cyco-btsniffer] Skipping invalid device {mac}: {e}")
                         logging.info(f"[cyco-btsniffer] Loaded {len(self.data)} devices from file")
                     except json.JSONDecodeError as je:
                         # File has invalid JSON, attempt recovery
@@ -84,21 +1123,37 @@ class CycoBtSniffer(plugins.Plugin):
             logging.error(f"[cyco-btsniffer] Error loading devices file: {e}")
             self.data = {}
 
-    def _save_devices_file(self, name=None):
-        """Safely save devices to JSON file"""
+    def _save_devices_file(self):
+        """Safely save devices to JSON file, or upsert the changed ones into the database"""
+        if self.db is not None:
+            with self.data_lock:
+                rows = [self.data[mac].to_row(mac) for mac in self.dirty]
+                with self.db:
+                    self.db.executemany(DEVICE_UPSERT, rows)
+                self.dirty.clear()
+            return
         try:
             # Write to temporary file first, then rename
             temp_file = self.options['devices_file'] + '.tmp'
 
             with open(temp_file, 'w') as f:
-                json.dump(self.data, f, indent=2)
+                with self.data_lock:
+                    _write_devices_json(f, self.data.items())
+                    written = set(self.dirty)
+                if self.options['durability'] != 'none':
+                    f.flush()
+                    os.fsync(f.fileno())
 
             # Atomic rename
             os.replace(temp_file, self.options['devices_file'])
-            if name:
-                logging.info("[cyco-btsniffer] Saving bluetooths %s into json.", name)
-            else:
-                logging.debug(f"[cyco-btsniffer] Saved {len(self.data)} devices to file")
+            if self.options['durability'] == 'full':
+                directory = os.open(os.path.dirname(os.path.abspath(temp_file)), os.O_RDONLY)
+                try:
+                    os.fsync(directory)
+                finally:
+                    os.close(directory)
+            with self.data_lock:
+                self.dirty -= written
 
         except Exception as e:
             logging.error(f"[cyco-btsniffer] Error saving devices file: {e}")
@@ -108,6 +1163,33 @@ class CycoBtSniffer(plugins.Plugin):
                     os.remove(temp_file)
             except:
                 pass
+            raise
+
+    def _maybe_flush(self, now):
+        """Write dirty devices once there are flush_max_dirty of them or the oldest waited flush_max_delay"""
+        with self.data_lock:
+            dirty = len(self.dirty)
+        if not dirty:
+            self.dirty_since = None
+            return
+        if self.dirty_since is None:
+            self.dirty_since = now
+        if dirty >= int(self.options['flush_max_dirty']) or now - self.dirty_since >= float(self.options['flush_max_delay']):
+            self.flush()
+
+    def flush(self):
+        with self.data_lock:
+            dirty = len(self.dirty)
+        if not dirty:
+            return
+        try:
+            self._save_devices_file()
+        except Exception as e:
+            logging.error(f"[cyco-btsniffer] Error saving devices: {e}")
+            return
+        self.flushes += 1
+        self.dirty_since = None
+        logging.info(f"[cyco-btsniffer] Flushed {dirty} changed devices ({self.flushes} flushes)")
 
     def on_ui_setup(self, ui):
         with ui._lock:
@@ -119,107 +1201,358 @@ class CycoBtSniffer(plugins.Plugin):
                                                label_font=fonts.Small,
                                                text_font=fonts.Small))
 
+    def _on_resolved(self, mac_address, kind, value):
+        with self.data_lock:
+            device = self.data.get(mac_address)
+            if device is None or getattr(device, kind) != 'Unknown':
+                return
+            self._unindex(mac_address, device)
+            setattr(device, kind, _intern(value))
+            device.new_info = 2
+            self._index(mac_address, device)
+            self.dirty.add(mac_address)
+        logging.info("[cyco-btsniffer] Got bluetooth %s %s for %s", kind, value, mac_address)
+
     def on_unload(self, ui):
+        self.scanner_stop.set()
+        if self.discovery is not None:
+            self.discovery.stop()
+        if self.resolver is not None:
+            self.resolver.stop()
+        if self.oui is not None:
+            self.oui.close()
+            self.oui = None
+        if self.scanner_thread is not None:
+            self.scanner_thread.join(timeout=10)
+        self.flush()
+        if self.db is not None:
+            try:
+                self.export_json()
+            except Exception as e:
+                logging.error(f"[cyco-btsniffer] Error exporting devices: {e}")
+            self.db.close()
+            self.db = None
         with ui._lock:
             ui.remove_element('BtS')
 
     def on_ui_update(self, ui):
-        current_time = time.time()
-        # Checking the time elapsed since last scan
-        if current_time - self.last_scan_time >= self.options['timer']:
-            self.last_scan_time = current_time
-            logging.info("[cyco-btsniffer] Bluetooth sniffed: %s", str(self.bt_sniff_info()))
-            ui.set('BtS', str(self.bt_sniff_info()))
-            self.scan(ui)
-
-    # Method for scanning the nearby bluetooth devices
-    def scan(self, display):
-        logging.info("[cyco-btsniffer] Scanning for bluetooth devices...")
-        current_time = time.time()
-        changed = False
-        device_class = None
-        last_name = None
+        # Only reads the last published snapshot, scanning happens on the scanner thread
+        snapshot = self.snapshot
+        ui.set('BtS', self.bt_sniff_info())
+        if snapshot.flushes != self.shown_flushes:
+            self.shown_flushes = snapshot.flushes
+            ui.set('status', 'Bluetooth sniffed and stored!')
 
-        # Running the system command hcitool to scan nearby bluetooth devices
-        cmd_inq = "hcitool inq --flush"
+    def on_webhook(self, path, request):
         try:
-            inq_output = subprocess.check_output(cmd_inq.split())
-            for line in inq_output.splitlines()[1:]:
-                fields = line.split()
-                mac_address = fields[0].decode()
-                last_name = mac_address
+            if render_template_string is None:
+                return "<html><body>Plugin not ready</body></html>"
+
+            if path is None:
+                path = ''
+
+            if path.startswith('api/stats'):
+                return self._json_response(self._device_stats(request))
+
+            try:
+                filters, page, per_page = self._device_filters(request)
+            except (TypeError, ValueError) as e:
+                if path.startswith('api/devices'):
+                    return self._json_response({'error': str(e)}, status=400)
+                return "<html><body>Invalid filter: " + html.escape(str(e)) + "</body></html>"
+            total, devices = self.query_devices(filters, page, per_page)
 
-                for i in range(len(fields)):
-                    if fields[i].decode() == "class:" and i + 1 < len(fields):
-                        device_class = fields[i + 1].decode()
+            if path.startswith('api/devices'):
+                return self._json_response({
+                    'page': page,
+                    'per_page': per_page,
+                    'total': total,
+                    'pages': (total + per_page - 1) // per_page,
+                    'devices': [dict(device.to_json(), mac=mac_address, days_seen=device.days_seen)
+                                for mac_address, device in devices],
+                    'scanner': self.scheduler.as_dict() if self.scheduler is not None else None,
+                    'flushes': self.flushes,
+                    'dirty': len(self.dirty),
+                })
+
+            return self._render_devices(request, filters, page, per_page, total, devices)
+
+        except Exception as e:
+            logging.error(f"[cyco-btsniffer] Webhook error: {e}", exc_info=True)
+            return "<html><body>Error: " + html.escape(str(e)) + "</body></html>"
+
+    def _json_response(self, body, status=200):
+        return Response(json.dumps(body), status=status, mimetype='application/json')
+
+    def _device_stats(self, request):
+        """Device counters per manufacturer and class, with ?check=1 recounted and compared first"""
+        args = request.args if request is not None else {}
+        stats = {}
+        if args.get('check'):
+            stats['consistent'] = self.check_counters()
+        with self.data_lock:
+            stats['counters'] = self.counters.as_dict()
+        return stats
+
+    def _device_filters(self, request):
+        """Filters and paging from the query string: manufacturer, class, name, since, min_count, min_days, at,
+        page and per_page"""
+        args = request.args if request is not None else {}
+        filters = {}
+        for arg, key in (('manufacturer', 'manufacturer'), ('class', 'device_class'), ('name', 'name')):
+            if args.get(arg):
+                filters[key] = args.get(arg)
+        since = args.get('since')
+        if since:
+            # Epoch seconds, or a date from the form
+            filters['since'] = int(since) if since.isdigit() else int(datetime.strptime(since, '%Y-%m-%d').timestamp())
+        if args.get('min_count'):
+            filters['min_count'] = int(args.get('min_count'))
+        if args.get('min_days'):
+            filters['min_days'] = int(args.get('min_days'))
+        at = args.get('at')
+        if at:
+            # Devices seen in the same hour of the week as this epoch timestamp, or as now
+            filters['at'] = int(time.time()) if at == 'now' else int(at)
+        page = max(1, int(args.get('page', 1)))
+        per_page = min(500, max(1, int(args.get('per_page', 50))))
+        return filters, page, per_page
+
+    def query_devices(self, filters, page=1, per_page=50):
+        """(total, [(mac, _Device)]) for one page of the devices matching filters, most recently seen first"""
+        start = (page - 1) * per_page
+        # Days seen and hours of the week are bitmaps, they are checked per device after the indexed filters
+        history = dict((key, filters[key]) for key in ('min_days', 'at') if filters.get(key) is not None)
+        filters = dict((key, value) for key, value in filters.items() if key not in history)
+        if self.db is None:
+            with self.data_lock:
+                macs = self.index.query(self.data, **filters)
+                if history:
+                    macs = [mac_address for mac_address in macs if _device_matches(self.data[mac_address], history)]
+                return len(macs), [(mac_address, self.data[mac_address]) for mac_address in macs[start:start + per_page]]
+        # The database has its own indexes. Changed devices that are not flushed yet come from memory instead,
+        # so queries never force a write
+        clauses, params = ["mac NOT IN (SELECT mac FROM pending)"], []
+        for key, clause in (('manufacturer', 'manufacturer = ?'), ('device_class', 'class = ?'),
+                            ('since', 'last_seen >= ?'), ('min_count', 'count >= ?')):
+            if filters.get(key) is not None:
+                clauses.append(clause)
+                params.append(filters[key])
+        if filters.get('name'):
+            clauses.append("name LIKE ? ESCAPE '\\'")
+            params.append('%' + re.sub(r'([%_\\])', r'\\\1', filters['name']) + '%')
+        where = ' WHERE ' + ' AND '.join(clauses)
+        order = lambda item: (item[1].last_seen, item[0])
+        with self.data_lock:
+            pending = [(mac_address, self.data[mac_address]) for mac_address in self.dirty if mac_address in self.data]
+            matches = sorted(((mac_address, device) for mac_address, device in pending
+                              if _device_matches(device, filters) and _device_matches(device, history)),
+                             key=order, reverse=True)
+            with self.db:
+                self.db.execute("DELETE FROM pending")
+                self.db.executemany("INSERT INTO pending VALUES (?)", [(mac_address,) for mac_address, device in pending])
+                if history:
+                    rows = self.db.execute("SELECT * FROM devices" + where + " AND days IS NOT NULL", params).fetchall()
+            if history:
+                stored = [(row[0], _Device.from_row(row[1:])) for row in rows]
+                merged = sorted([item for item in stored if _device_matches(item[1], history)] + matches,
+                                key=order, reverse=True)
+                return len(merged), merged[start:start + per_page]
+            with self.db:
+                total = self.db.execute("SELECT COUNT(*) FROM devices" + where, params).fetchone()[0]
+                # At most len(matches) pending devices sort in front of the page, so this window of rows
+                # holds every database device on it
+                offset = max(0, min(start - len(matches), total - 1))
+                rows = self.db.execute("SELECT * FROM devices" + where + " ORDER BY last_seen DESC, mac DESC LIMIT ? OFFSET ?",
+                                       params + [per_page + len(matches), offset]).fetchall()
+        stored = [(row[0], _Device.from_row(row[1:])) for row in rows]
+        before = []
+        if offset > 0 and stored:
+            # Pending devices in front of the first row are on earlier pages
+            first = order(stored[0])
+            before = [item for item in matches if order(item) > first]
+            matches = [item for item in matches if order(item) < first]
+        merged = sorted(stored + matches, key=order, reverse=True)
+        skip = start - offset - len(before)
+        return total + len(before) + len(matches), merged[skip:skip + per_page]
+
+    def _render_devices(self, request, filters, page, per_page, total, devices):
+        args = request.args if request is not None else {}
+        rows = ""
+        for mac_address, device in devices:
+            rows += "<tr><td>" + mac_address + "</td><td>" + html.escape(str(device.name)) + "</td><td>" + \
+                    html.escape(str(device.manufacturer)) + "</td><td>" + html.escape(str(device.device_class)) + "</td><td>" + \
+                    str(device.count) + "</td><td>" + _format_time(device.first_seen) + "</td><td>" + \
+                    _format_time(device.last_seen) + "</td><td>" + str(device.days_seen) + "</td></tr>"
+        if not rows:
+            rows = "<tr><td colspan='8' style='text-align: center; padding: 20px;'>No devices found</td></tr>"
+
+        query = dict((arg, args.get(arg)) for arg in ('manufacturer', 'class', 'name', 'since', 'min_count', 'min_days', 'at')
+                     if args.get(arg))
+        query['per_page'] = per_page
+        pages = max(1, (total + per_page - 1) // per_page)
+        paging = "Page " + str(page) + " of " + str(pages) + " (" + str(total) + " devices)"
+        if page > 1:
+            paging = "<a href=\"?" + html.escape(urllib.parse.urlencode(dict(query, page=page - 1))) + "\">Previous</a> " + paging
+        if page < pages:
+            paging += " <a href=\"?" + html.escape(urllib.parse.urlencode(dict(query, page=page + 1))) + "\">Next</a>"
+
+        form = ""
+        for arg, label, kind in (('manufacturer', 'Manufacturer', 'text'), ('class', 'Class', 'text'), ('name', 'Name', 'text'),
+                                 ('since', 'Seen since', 'date'), ('min_count', 'Count at least', 'number'),
+                                 ('min_days', 'Days seen at least', 'number'), ('at', 'Usually around at (epoch or now)', 'text')):
+            form += "<label style=\"margin-right: 10px;\">" + label + " <input type=\"" + kind + "\" name=\"" + arg + \
+                    "\" value=\"" + html.escape(args.get(arg) or '') + "\"></label>"
+        counters = self.counters
+        with self.data_lock:
+            top = [(counters.by_manufacturer.most_common(5), 'Top manufacturers'), (counters.by_class.most_common(5), 'Top classes')]
+        breakdown = ""
+        for common, label in top:
+            if common:
+                breakdown += "<p><strong>" + label + ":</strong> " + \
+                             ', '.join(html.escape(str(key)) + " (" + str(count) + ")" for key, count in common) + "</p>"
+        breakdown += "<p><a href=\"/plugins/cyco-btsniffer/api/stats\">All counters</a> " + \
+                     "<a href=\"/plugins/cyco-btsniffer/api/stats?check=1\">Check counters</a></p>"
+        scanner = "<p><strong>Flushes:</strong> " + str(self.flushes) + " (" + str(len(self.dirty)) + " changed devices pending)</p>"
+        if self.scheduler is not None:
+            stats = self.scheduler.as_dict()
+            scanner += "<p><strong>Scanning:</strong> every " + str(int(stats['interval'])) + "s (" + str(stats['scans_per_hour']) + \
+                      " scans/hour, " + str(stats['new_per_scan']) + " new devices per scan)</p>"
+
+        # Device names come from the air, everything is escaped and passed in as a variable instead of template text
+        page_html = """<div style="margin-bottom: 20px; padding: 15px; background-color: #f0f0f0; border-radius: 5px;">
+<p><strong>Devices:</strong> """ + str(counters.total) + """ (""" + str(counters.known) + """ known, """ + str(counters.unknown) + """ unknown)</p>
+""" + breakdown + """
+""" + scanner + """
+<form method="get" action="/plugins/cyco-btsniffer/">""" + form + """
+<button type="submit" style="padding: 5px 10px; background-color: #2196F3; color: white; border: none; border-radius: 3px; cursor: pointer;">Filter</button>
+<a href="/plugins/cyco-btsniffer/api/devices?""" + html.escape(urllib.parse.urlencode(dict(query, page=page))) + """">JSON</a>
+</form>
+</div>
+<p>""" + paging + """</p>
+<table style="width: 100%; border-collapse: collapse; margin-top: 20px;">
+<thead><tr style="background-color: #f2f2f2;">
+<th style="padding: 12px; text-align: left; border-bottom: 1px solid #ddd;">MAC</th>
+<th style="padding: 12px; text-align: left; border-bottom: 1px solid #ddd;">Name</th>
+<th style="padding: 12px; text-align: left; border-bottom: 1px solid #ddd;">Manufacturer</th>
+<th style="padding: 12px; text-align: left; border-bottom: 1px solid #ddd;">Class</th>
+<th style="padding: 12px; text-align: left; border-bottom: 1px solid #ddd;">Count</th>
+<th style="padding: 12px; text-align: left; border-bottom: 1px solid #ddd;">First Seen</th>
+<th style="padding: 12px; text-align: left; border-bottom: 1px solid #ddd;">Last Seen</th>
+<th style="padding: 12px; text-align: left; border-bottom: 1px solid #ddd;">Days Seen</th>
+</tr></thead>
+<tbody>
+""" + rows + """
+</tbody>
+</table>"""
+
+        template = """{% extends "base.html" %}
+{% set active_page = "plugins" %}
+{% block title %}Bluetooth Devices{% endblock %}
+{% block content %}
+<div id="container">
+<h1>Bluetooth Devices</h1>
+{{ page_html|safe }}
+</div>
+{% endblock %}
+"""
+        return render_template_string(template, page_html=page_html)
+
+    # Method for processing the bluetooth devices the discovery session found since the last scan
+    def scan(self):
+        """Returns the number of new devices and of known devices that changed or came back"""
+        sightings = self.discovery.drain() if self.discovery is not None else []
+        logging.info("[cyco-btsniffer] Processing %d bluetooth sightings...", len(sightings))
+        current_time = time.time()
+        new = 0
+        changed = set()
+
+        try:
+            for sighting in sightings:
+                mac_address = sighting.mac
+                device_class = sighting.device_class
 
                 logging.info("[cyco-btsniffer] Found bluetooth %s", mac_address)
 
                 # Update the count, first_seen, and last_seen time of the device
-                if mac_address in self.data and len(self.data) > 0:
-                    if 'Unknown' == self.data[mac_address]['name']:
-                        name = self.get_device_name(mac_address)
-                        self.data[mac_address]['name'] = name
-                        self.data[mac_address]['new_info'] = 2
-                        logging.info("[cyco-btsniffer] Updated bluetooth name: %s", name)
-                        changed = True
-
-                    if 'Unknown' == self.data[mac_address]['manufacturer']:
-                        manufacturer = self.get_device_manufacturer(mac_address)
-                        self.data[mac_address]['manufacturer'] = manufacturer
-                        self.data[mac_address]['new_info'] = 2
-                        logging.info("[cyco-btsniffer] Updated bluetooth manufacturer: %s", manufacturer)
-                        changed = True
-
-                    if device_class != self.data[mac_address]['class']:
-                        self.data[mac_address]['class'] = device_class
-                        self.data[mac_address]['new_info'] = 2
+                device = self._get_device(mac_address)
+                if device is not None:
+                    if 'Unknown' == device.name:
+                        if sighting.name:
+                            self._update_device(mac_address, device, 'name', sighting.name)
+                            changed.add(mac_address)
+                            logging.info("[cyco-btsniffer] Updated bluetooth name: %s", sighting.name)
+                        else:
+                            self.resolver.submit(mac_address, 'name')
+
+                    if 'Unknown' == device.manufacturer:
+                        vendor = self._lookup_manufacturer(mac_address)
+                        if vendor is not None:
+                            self._update_device(mac_address, device, 'manufacturer', vendor)
+                            changed.add(mac_address)
+                            logging.info("[cyco-btsniffer] Updated bluetooth manufacturer: %s", vendor)
+                        elif self.options['hcitool_manufacturer']:
+                            self.resolver.submit(mac_address, 'manufacturer')
+
+                    if device_class != device.device_class:
+                        self._update_device(mac_address, device, 'device_class', device_class)
+                        changed.add(mac_address)
                         logging.info("[cyco-btsniffer] Updated bluetooth class: %s", device_class)
-                        changed = True
-
-                    last_seen_time = int(
-                        datetime.strptime(self.data[mac_address]['last_seen'], '%H:%M:%S %d-%m-%Y').timestamp())
-                    if current_time - last_seen_time >= self.options['count_interval']:
-                        self.data[mac_address]['count'] += 1
-                        self.data[mac_address]['last_seen'] = time.strftime('%H:%M:%S %d-%m-%Y',
-                                                                             time.localtime(current_time))
-                        self.data[mac_address]['new_info'] = 2
+
+                    if current_time - device.last_seen >= self.options['count_interval']:
+                        with self.data_lock:
+                            self._unindex(mac_address, device)
+                            device.count += 1
+                            device.last_seen = int(current_time)
+                            self._index(mac_address, device)
+                            device.new_info = 2
+                            self.dirty.add(mac_address)
+                        changed.add(mac_address)
                         logging.info("[cyco-btsniffer] Updated bluetooth count.")
-                        changed = True
 
                 else:
-                    name = self.get_device_name(mac_address)
-                    manufacturer = self.get_device_manufacturer(mac_address)
-                    self.data[mac_address] = {'name': name, 'count': 1, 'class': device_class,
-                                              'manufacturer': manufacturer,
-                                              'first_seen': time.strftime('%H:%M:%S %d-%m-%Y',
-                                                                          time.localtime(current_time)),
-                                              'last_seen': time.strftime('%H:%M:%S %d-%m-%Y',
-                                                                         time.localtime(current_time)),
-                                              'new_info': True}
+                    name = sighting.name or 'Unknown'
+                    manufacturer = self._lookup_manufacturer(mac_address) or 'Unknown'
+                    with self.data_lock:
+                        device = self.data[mac_address] = _Device(name, 1, device_class, manufacturer,
+                                                                  int(current_time), int(current_time), True)
+                        self._index(mac_address, device)
+                        self.dirty.add(mac_address)
                     logging.info("[cyco-btsniffer] Added new bluetooth device %s with MAC: %s", name, mac_address)
-                    changed = True
+                    self.last_new = mac_address
+                    new += 1
+                    if name == 'Unknown':
+                        self.resolver.submit(mac_address, 'name')
+                    if manufacturer == 'Unknown' and self.options['hcitool_manufacturer']:
+                        self.resolver.submit(mac_address, 'manufacturer')
 
-        except subprocess.CalledProcessError as e:
-            logging.error("[cyco-btsniffer] Error running command: %s", e)
+                # Every sighting goes into the history, at most one per history_resolution seconds
+                with self.data_lock:
+                    if device.record(sighting.time, int(self.options['history_size']),
+                                     float(self.options['history_resolution'])):
+                        self.dirty.add(mac_address)
 
-        # Save the updated devices to the JSON file
-        if changed:
-            try:
-                self._save_devices_file(last_name)
-                display.set('status', 'Bluetooth sniffed and stored!')
-                display.update(force=True)
-            except KeyError as e:
-                logging.error(f"[cyco-btsniffer] KeyError accessing options: {e}")
-            except Exception as e:
-                logging.error(f"[cyco-btsniffer] Error saving devices: {e}")
+        except (KeyError, ValueError) as e:
+            logging.error("[cyco-btsniffer] Error processing sightings: %s", e)
+
+        # Changed devices are written in batches, see _maybe_flush
+        self._maybe_flush(current_time)
+
+        self._publish_snapshot(current_time)
+        return new, len(changed)
 
     # Method to get the device name
     def get_device_name(self, mac_address):
         logging.info("[cyco-btsniffer] Trying to get name for %s", mac_address)
         name = 'Unknown'
         hcitool_process = subprocess.Popen(["hcitool", "name", mac_address], stdout=subprocess.PIPE)
-        output, error = hcitool_process.communicate()
+        try:
+            output, error = hcitool_process.communicate(timeout=float(self.options['resolver_timeout']))
+        except subprocess.TimeoutExpired:
+            logging.info("[cyco-btsniffer] Timeout while trying to get name for %s", mac_address)
+            hcitool_process.kill()
+            hcitool_process.communicate()
+            return name
         if output.decode().strip() != '':
             name = output.decode().strip()
             logging.info("[cyco-btsniffer] Got name %s for %s", name, mac_address)
@@ -228,31 +1561,21 @@ class CycoBtSniffer(plugins.Plugin):
     # Method to get the device manufacturer
     def get_device_manufacturer(self, mac_address):
         manufacturer = 'Unknown'
-        cmd_info = f"hcitool info {mac_address} | grep 'Manufacturer:' | cut -d ' ' -f 2-"
         try:
             logging.info("[cyco-btsniffer] Trying to get manufacturer for %s", mac_address)
-            start_time = time.time()
-            process = subprocess.Popen(cmd_info, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-            while process.poll() is None:
-                time.sleep(0.1)
-                if time.time() - start_time > 7:
-                    logging.info("[cyco-btsniffer] Timeout while trying to get manufacturer for %s", mac_address)
-                    process.kill()
-                    return manufacturer
-            output, error = process.communicate(timeout=1)
-            if output.decode().strip() != '':
-                manufacturer = output.decode().strip()
+            output = subprocess.run(["hcitool", "info", mac_address], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                    timeout=float(self.options['resolver_timeout'])).stdout
+            for line in output.decode(errors='replace').splitlines():
+                if line.strip().startswith('Manufacturer:'):
+                    manufacturer = line.strip()[len('Manufacturer:'):].strip() or manufacturer
+            if manufacturer != 'Unknown':
                 logging.info("[cyco-btsniffer] Got manufacturer %s for %s", manufacturer, mac_address)
+        except subprocess.TimeoutExpired:
+            logging.info("[cyco-btsniffer] Timeout while trying to get manufacturer for %s", mac_address)
         except Exception as e:
             logging.info("[cyco-btsniffer] Error while trying to get manufacturer for %s: %s", mac_address, str(e))
         return manufacturer
 
     def bt_sniff_info(self):
-        num_devices = len(self.data)
-        if num_devices > 0:
-            num_unknown = sum(1 for device in self.data.values() if device['name'] == 'Unknown' or device['manufacturer'] == 'Unknown')
-            num_known = num_devices - num_unknown
-            return_text = "%s|%s" % (num_devices, num_known)
-        else:
-            return_text = "0|0"
-        return return_text
+        snapshot = self.snapshot
+        return "%s|%s" % (snapshot.devices, snapshot.known)